@@ -0,0 +1,64 @@
+"""
+補齊進度檢查點（本機快取 backfill_checkpoint.json）：記錄每支股票已寫入 Sheets 的最後日期、
+已完成的股票與累計 FinMind 請求數。程式中斷或被 Render 終止後，同一個補齊區間重新執行時
+從中斷處繼續，已完成的股票直接跳過。
+區間涵蓋今天時（預設迄日），今天的日K可能尚未公布：這天要實際寫入資料後才記入進度，
+同一天稍後重新執行會再抓一次今天，不會因為稍早的執行已標記完成而漏掉。
+"""
+from datetime import datetime, timedelta
+
+from local_cache import cache_path, load_json, save_json
+
+
+class BackfillCheckpoint:
+    def __init__(self, start_date, end_date, path=None, open_date=None):
+        self.path = path or cache_path("backfill_checkpoint.json")
+        self.job = {"start": start_date, "end": end_date}
+        # 資料可能尚未定案的日期（今天）；不在區間內時不需特別處理
+        self.open_date = open_date if open_date and start_date <= open_date <= end_date else None
+        data = load_json(self.path, {}) or {}
+        if data.get("job") != self.job:
+            data = {}  # 不同補齊區間視為新的工作
+        self.resumed = bool(data)
+        self.stocks = data.get("stocks", {})  # stock_id → {"committed_through": 日期, "done": bool}
+        self.requests_used = data.get("requests_used", 0)
+        self.last = data.get("last")          # 最後一次寫入的 {"stock_id", "date"}
+
+    def is_done(self, stock_id):
+        return self.stocks.get(stock_id, {}).get("done", False)
+
+    def committed_through(self, stock_id):
+        return self.stocks.get(stock_id, {}).get("committed_through")
+
+    def resume_date(self, stock_id, start_date):
+        """這支股票本次要從哪一天開始補；已完成回傳 None。"""
+        if self.is_done(stock_id):
+            return None
+        committed = self.committed_through(stock_id)
+        if committed and committed >= start_date:
+            return (datetime.strptime(committed, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        return start_date
+
+    def settled_date(self, date, has_open_bar):
+        """進度可記到的日期：涵蓋 open_date 但這天還沒有資料時只記到前一天，下次重新抓取這天。"""
+        if self.open_date and date >= self.open_date and not has_open_bar:
+            return (datetime.strptime(self.open_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        return date
+
+    def commit(self, progress, finished):
+        """資料確定寫入後才呼叫：progress 為 {stock_id: 已處理到的日期}，finished 為已全部完成的股票。"""
+        for stock_id, date in progress.items():
+            entry = self.stocks.setdefault(stock_id, {"committed_through": None, "done": False})
+            if not entry["committed_through"] or date > entry["committed_through"]:
+                entry["committed_through"] = date
+                self.last = {"stock_id": stock_id, "date": date}
+        for stock_id in finished:
+            entry = self.stocks.setdefault(stock_id, {"committed_through": None, "done": False})
+            if self.open_date and (entry["committed_through"] or "") < self.open_date:
+                continue  # 今天的日K還沒寫入，不算完成
+            entry["done"] = True
+        self.save()
+
+    def save(self):
+        save_json(self.path, {"job": self.job, "stocks": self.stocks,
+                              "requests_used": self.requests_used, "last": self.last})
@@ -0,0 +1,151 @@
+"""
+量測 stock-history-fill.py 串流補齊的峰值記憶體（RSS）：同樣的股票數，補 90 天與補 10 年
+應該用到差不多的記憶體。FinMind 與 Sheets 以本機假物件代替（不連網），每個區間在獨立行程執行。
+量測前先檢查命令列入口，確認排程實際執行的路徑可以跑完：直接執行 stock-history-fill.py --dry-run
+（Sheets 連線失敗後正常結束，並寫入執行紀錄），再以同樣的假物件走一遍 parse_args／main
+（--dry-run、--start/--end、--migrate-layout、錯誤日期）。
+
+用法：python bench_backfill.py [--stocks 12] [--days 90,365,3650] [--skip-cli-check]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock-history-fill.py")
+
+FAKES = r'''
+import importlib.util, json, os, resource, sys, time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+spec = importlib.util.spec_from_file_location("stock_history_fill", SCRIPT)
+fill = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fill)
+fill.FINMIND_RATE_LIMITER = fill.RateLimiter(0)  # 假資料不需限流
+fill.SHEETS_RATE_LIMITER = fill.RateLimiter(0)
+fill.LOGGER.echo = False
+
+
+class SyntheticLoader:
+    """依日期產生確定性的假日K（只有平日），資料量與真實 FinMind 相同。"""
+    def login_by_token(self, api_token):
+        pass
+
+    def taiwan_stock_daily(self, stock_id, start_date, end_date):
+        dates = pd.bdate_range(start_date, end_date)
+        closes = [100 + (d.toordinal() * 7 + len(stock_id)) % 50 for d in dates]
+        return pd.DataFrame({"date": dates.strftime("%Y-%m-%d"), "stock_id": stock_id, "close": closes,
+                             "open": closes, "max": closes, "min": closes, "Trading_Volume": 0})
+
+
+class _Call:
+    def __init__(self, result):
+        self.result = result
+    def execute(self):
+        return self.result
+
+
+class NullSheets:
+    """接受所有寫入、讀取回傳空表的 Sheets 假物件；只記錄寫入筆數。"""
+    def __init__(self):
+        self.rows = 0
+    def spreadsheets(self):
+        return self
+    def values(self):
+        return self
+    def get(self, **kw):
+        return _Call({"values": [], "sheets": []})
+    def batchGet(self, ranges, **kw):
+        return _Call({"valueRanges": [{} for _ in ranges]})
+    def append(self, body, **kw):
+        self.rows += len(body["values"])
+        return _Call({"updates": {}})
+    def batchUpdate(self, body, **kw):
+        return _Call({})
+'''
+
+CHILD = FAKES + r'''
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+service = NullSheets()
+stocks = [str(2300 + i) for i in range(STOCKS)]
+end = datetime(2026, 10, 16)
+start = (end - timedelta(days=DAYS)).strftime("%Y-%m-%d")
+t0 = time.perf_counter()
+fill.fill_missing_history(service, SyntheticLoader(), stocks, {}, start_date=start, end_date=end.strftime("%Y-%m-%d"))
+print(json.dumps({"days": DAYS, "rows": service.rows, "seconds": round(time.perf_counter() - t0, 2),
+                  "base_mib": round(base, 1), "peak_mib": round(fill.peak_rss_mib(), 1)}))
+'''
+
+CLI_CHECK = FAKES + r'''
+service = NullSheets()
+fill.get_sheets_service = lambda: service
+fill.DataLoader = SyntheticLoader
+for argv in (["--dry-run"], ["--start", "2026-09-01", "--end", "2026-10-16"], ["--dry-run"], ["--migrate-layout"]):
+    sys.argv = [SCRIPT] + argv
+    fill.main()
+    print("ok", " ".join(argv), "rows", service.rows, file=sys.stderr)
+if not service.rows:
+    sys.exit("--start/--end 沒有寫入任何資料")
+sys.argv = [SCRIPT, "--start", "2026/09/01"]
+try:
+    fill.main()
+except SystemExit as e:
+    if e.code != 2:
+        raise
+else:
+    sys.exit("錯誤日期格式沒有被 argparse 拒絕")
+print("ok")
+'''
+
+
+def check_cli(env):
+    """執行腳本本身與以假物件執行 main()（含 parse_args），任何例外都讓量測直接失敗。"""
+    ledger = os.path.join(env["STOCK_CACHE_DIR"], "run_ledger.jsonl")
+    env = dict(env, RUN_LEDGER_FILE=ledger)
+    proc = subprocess.run([sys.executable, SCRIPT, "--dry-run"], env=env, capture_output=True, text=True)
+    statuses = [json.loads(line)["status"] for line in open(ledger, encoding="utf-8")] if os.path.exists(ledger) else []
+    if proc.returncode != 0 or statuses[-1:] != ["ok"]:
+        print(proc.stderr.strip(), file=sys.stderr)
+        sys.exit("命令列入口檢查失敗：stock-history-fill.py --dry-run 未正常結束")
+
+    code = f"SCRIPT = {SCRIPT!r}\n" + CLI_CHECK
+    proc = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    if proc.returncode != 0 or proc.stdout.strip().splitlines()[-1:] != ["ok"]:
+        print(proc.stderr.strip(), file=sys.stderr)
+        sys.exit("命令列入口檢查失敗")
+    print("命令列入口檢查通過（腳本 --dry-run；main：--dry-run、--start/--end、--migrate-layout、錯誤日期）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="量測串流補齊的峰值記憶體")
+    parser.add_argument("--stocks", type=int, default=12, help="股票數（預設 12）")
+    parser.add_argument("--days", default="90,365,3650", help="補齊天數，逗號分隔（預設 90,365,3650）")
+    parser.add_argument("--skip-cli-check", action="store_true", help="略過命令列入口檢查")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, GOOGLE_SHEETS_CREDENTIALS="{}", GOOGLE_SHEET_ID="bench", FINMIND_TOKEN="bench",
+                   STOCK_CACHE_DIR=cache_dir, LOG_FILE=os.path.join(cache_dir, "bench.log"),
+                   RUN_METRICS_FILE=os.path.join(cache_dir, "run_metrics.jsonl"))
+        if not args.skip_cli_check:
+            cli_cache = os.path.join(cache_dir, "cli")
+            os.makedirs(cli_cache)
+            check_cli(dict(env, STOCK_CACHE_DIR=cli_cache))
+        print(f"{'天數':>6} {'寫入筆數':>10} {'耗時':>8} {'匯入後 RSS':>12} {'峰值 RSS':>10}")
+        for days in (int(d) for d in args.days.split(",")):
+            code = f"SCRIPT = {SCRIPT!r}\nSTOCKS = {args.stocks}\nDAYS = {days}\n" + CHILD
+            proc = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(proc.stderr.strip(), file=sys.stderr)
+                sys.exit(1)
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(f"{result['days']:>6} {result['rows']:>10} {result['seconds']:>7.2f}s "
+                  f"{result['base_mib']:>10.1f} MiB {result['peak_mib']:>6.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
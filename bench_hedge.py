@@ -0,0 +1,94 @@
+"""
+以 FakeProvider 驗證 price_providers.HedgedResolver 的行為（不連網，約 3 秒）：
+- hedge：目前來源超過 hedge 延遲仍未回應，同時啟動下一個來源，先回應者為準
+- 先取得有效價格者為準：第一個來源在 hedge 延遲內回應，就不啟動下一個
+- 來源回傳無資料或拋出例外時立刻換下一個，不必等 hedge 延遲；全部失敗回傳 None
+- 本機限流：等待 token 的時間不算來源延遲，也不會觸發 hedge
+
+用法：python bench_hedge.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+from price_providers import FakeProvider, HedgedResolver, LatencyStats
+from rate_limit import RateLimiter
+
+TODAY = "2026-10-16"
+
+
+def resolve(cache_dir, providers, hedge_delay):
+    """回傳 (結果, 耗時, hedge 次數, LatencyStats)。"""
+    stats = LatencyStats(hedge_delay, min_delay=0.0, path=os.path.join(cache_dir, "latency.json"))
+    resolver = HedgedResolver(stats, log=lambda msg: None)
+    start = time.monotonic()
+    result = resolver.resolve("2330", TODAY, providers)
+    return result, time.monotonic() - start, resolver.hedges, stats
+
+
+def scenario_hedge(cache_dir):
+    slow = FakeProvider("slow", {"2330": 1000}, delay=1.0)
+    fast = FakeProvider("fast", {"2330": 999}, delay=0.05)
+    result, elapsed, hedges, _ = resolve(cache_dir, [slow, fast], 0.3)
+    ok = result and result["price"] == 999 and hedges == 1 and elapsed < 0.6
+    return ok, f"慢的來源 1.0 秒、hedge 延遲 0.3 秒 → 取得 {result and result['price']}，{elapsed:.2f}s，hedge {hedges} 次"
+
+
+def scenario_first_valid(cache_dir):
+    primary = FakeProvider("primary", {"2330": 1000}, delay=0.1)
+    backup = FakeProvider("backup", {"2330": 999}, delay=0.05)
+    result, elapsed, hedges, _ = resolve(cache_dir, [primary, backup], 0.5)
+    ok = result and result["price"] == 1000 and hedges == 0 and backup.calls == 0
+    return ok, f"第一個來源 0.1 秒內回應 → 取得 {result and result['price']}，備援呼叫 {backup.calls} 次"
+
+
+def scenario_fall_through(cache_dir):
+    empty = FakeProvider("empty", {}, delay=0.05)
+    failing = FakeProvider("failing", {}, fail=True)
+    backup = FakeProvider("backup", {"2330": 999}, delay=0.05)
+    result, elapsed, hedges, _ = resolve(cache_dir, [empty, failing, backup], 5.0)
+    ok = result and result["price"] == 999 and hedges == 0 and elapsed < 0.5
+    return ok, f"無資料、例外後換下一個（hedge 延遲 5 秒）→ 取得 {result and result['price']}，{elapsed:.2f}s"
+
+
+def scenario_all_fail(cache_dir):
+    empty = FakeProvider("empty", {})
+    failing = FakeProvider("failing", {}, fail=True)
+    result, elapsed, hedges, _ = resolve(cache_dir, [empty, failing], 5.0)
+    return result is None and elapsed < 0.5, f"所有來源都失敗 → {result}，{elapsed:.2f}s"
+
+
+def scenario_limiter_wait(cache_dir):
+    limiter = RateLimiter(2)  # 每 0.5 秒一個 token
+    limiter.acquire()         # 先用掉，下一個 token 要等約 0.5 秒
+    primary = FakeProvider("primary", {"2330": 1000}, delay=0.1, limiter=limiter)
+    backup = FakeProvider("backup", {"2330": 999}, delay=0.05)
+    result, elapsed, hedges, stats = resolve(cache_dir, [primary, backup], 0.3)
+    measured = stats.stats.get("primary", {}).get("avg", float("nan"))  # hedge 後可能尚未回應
+    ok = bool(result) and result["price"] == 1000 and hedges == 0 and measured < 0.3
+    return ok, (f"限流等待約 0.5 秒、hedge 延遲 0.3 秒 → 取得 {result and result['price']}，"
+                f"hedge {hedges} 次，記錄延遲 {measured:.2f}s")
+
+
+SCENARIOS = {
+    "hedge": scenario_hedge,
+    "first": scenario_first_valid,
+    "fallthru": scenario_fall_through,
+    "allfail": scenario_all_fail,
+    "limiter": scenario_limiter_wait,
+}
+
+
+def main():
+    failed = False
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, scenario in SCENARIOS.items():
+            ok, detail = scenario(cache_dir)
+            failed = failed or not ok
+            print(f"{'✅' if ok else '❌'} {name:<9} {detail}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
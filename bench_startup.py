@@ -0,0 +1,92 @@
+"""
+量測 stock-multi-notify.py 在「不需要做事」的時段的啟動到結束時間（含 Python 直譯器啟動），
+並確認這些路徑沒有載入 pandas／FinMind／yfinance／googleapiclient。
+
+情境（以 NOTIFY_NOW 指定時間，環境變數全部用假值，不會連線）：
+- premarket：平日 08:30
+- weekend：週六 10:00
+- holiday：平日 10:00，本機交易日曆已收錄當天為休市
+
+用法：python bench_startup.py [--runs 5] [--max-seconds 1.0]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock-multi-notify.py")
+HEAVY_MODULES = ["pandas", "FinMind", "yfinance", "googleapiclient", "requests"]
+HOLIDAY = "2026-10-09"  # 國慶日連假（週五）
+
+SCENARIOS = {
+    "premarket": "2026-10-14T08:30:00",
+    "weekend": "2026-10-17T10:00:00",
+    "holiday": f"{HOLIDAY}T10:00:00",
+}
+
+CHILD = f"""
+import json, runpy, sys
+runpy.run_path({SCRIPT!r}, run_name="__main__")
+print(json.dumps(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)))
+"""
+
+
+def seed_calendar(cache_dir):
+    """建立收錄到假日之後的交易日曆，讓 holiday 情境可直接查表結束。"""
+    start = date(2026, 9, 1)
+    days = [start + timedelta(days=i) for i in range(60)]
+    trading = [d.isoformat() for d in days if d.weekday() < 5 and d.isoformat() != HOLIDAY]
+    with open(os.path.join(cache_dir, "trading_calendar.json"), "w", encoding="utf-8") as f:
+        json.dump({"trading_dates": trading, "covered_through": trading[-1],
+                   "refreshed": trading[-1], "decided": {}}, f)
+
+
+def run_once(env):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip() or proc.stdout.strip())
+    loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+    return elapsed, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="量測推播程式快速結束路徑的啟動時間")
+    parser.add_argument("--runs", type=int, default=5, help="每個情境執行次數（預設 5）")
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="中位數超過此秒數即回傳失敗（預設 1.0）")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cache_dir:
+        seed_calendar(cache_dir)
+        base_env = dict(
+            os.environ,
+            GOOGLE_SHEETS_CREDENTIALS="{}",
+            GOOGLE_SHEET_ID="bench",
+            FINMIND_TOKEN="bench",
+            DISCORD_WEBHOOK_URL="http://127.0.0.1:9/webhook",
+            STOCK_CACHE_DIR=cache_dir,
+            LOG_FILE=os.path.join(cache_dir, "bench.log"),
+            RUN_METRICS_FILE=os.path.join(cache_dir, "run_metrics.jsonl"),
+        )
+        for name, now in SCENARIOS.items():
+            env = dict(base_env, NOTIFY_NOW=now)
+            results = [run_once(env) for _ in range(args.runs)]
+            times = [t for t, _ in results]
+            loaded = sorted({m for _, mods in results for m in mods})
+            median = statistics.median(times)
+            ok = median <= args.max_seconds and not loaded
+            failed = failed or not ok
+            print(f"{'✅' if ok else '❌'} {name:<10} 中位數 {median:.3f}s  最長 {max(times):.3f}s  "
+                  f"載入重型模組：{', '.join(loaded) if loaded else '無'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+非同步緩衝日誌：write_log 只把紀錄放進記憶體環形緩衝區，由背景執行緒批次寫入 error.log，
+不再每一行都開檔／關檔；支援 JSON 格式、依大小或日期輪替，程式結束時保證寫完。
+
+環境變數：
+- LOG_FILE：日誌檔路徑（預設 error.log）
+- LOG_FORMAT：text（預設）或 json
+- LOG_ROTATE：size（預設，超過 LOG_MAX_BYTES 輪替）或 daily（每天一個檔）
+- LOG_MAX_BYTES：大小輪替門檻（預設 5 MB）；LOG_BACKUPS：保留的舊檔數（預設 5）
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+
+class BufferedLogger:
+    def __init__(self, path="error.log", time_format="%Y-%m-%d %H:%M:%S", json_format=False,
+                 rotate="size", max_bytes=5 * 1024 * 1024, backup_count=5,
+                 buffer_size=10000, batch_size=200, flush_interval=1.0, echo=True):
+        self.path = path
+        self.time_format = time_format
+        self.json_format = json_format
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.echo = echo
+        self._buffer = deque(maxlen=buffer_size)  # 寫入跟不上時丟棄最舊的紀錄，記憶體不會無限增長
+        self.dropped = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, msg, **fields):
+        now = datetime.now()
+        now_str = now.strftime(self.time_format)
+        if self.echo:
+            print(f"{now_str} {msg}")
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((now, now_str, msg, fields))
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    def _format(self, record):
+        now, now_str, msg, fields = record
+        if self.json_format:
+            return json.dumps({"ts": now.isoformat(timespec="seconds"), "msg": msg, **fields},
+                              ensure_ascii=False, default=str)
+        return f"{now_str} {msg}"
+
+    def _drain(self):
+        records = []
+        while self._buffer:
+            try:
+                records.append(self._buffer.popleft())
+            except IndexError:
+                break
+        return records
+
+    def flush(self):
+        with self._write_lock:
+            records = self._drain()
+            if not records:
+                return
+            lines = [self._format(r) for r in records]
+            if self.dropped:
+                lines.append(f"{records[-1][1]} ⚠️ 日誌緩衝區已滿，丟棄 {self.dropped} 筆較舊紀錄")
+                self.dropped = 0
+            data = "\n".join(lines) + "\n"
+            self._rotate_if_needed(len(data.encode("utf-8")), records[0][0])
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+
+    def _rotate_if_needed(self, incoming, now):
+        if not os.path.exists(self.path):
+            return
+        if self.rotate == "daily":
+            file_day = datetime.fromtimestamp(os.path.getmtime(self.path)).strftime("%Y-%m-%d")
+            if file_day != now.strftime("%Y-%m-%d"):
+                os.replace(self.path, f"{self.path}.{file_day}")
+                dated = sorted(glob.glob(f"{glob.escape(self.path)}.????-??-??"))
+                for old in dated[:-self.backup_count] if self.backup_count else dated:
+                    os.remove(old)
+            return
+        if self.max_bytes and os.path.getsize(self.path) + incoming > self.max_bytes:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            if self.backup_count:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"日誌寫入失敗：{e}")
+
+    def close(self):
+        """停止背景執行緒並寫完緩衝區內所有紀錄（程式結束時由 atexit 自動呼叫）。"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+
+def create_logger(time_format):
+    """依環境變數建立兩支程式共用設定的 logger；time_format 沿用各程式原本的時間格式。"""
+    return BufferedLogger(
+        path=os.getenv("LOG_FILE", "error.log"),
+        time_format=time_format,
+        json_format=os.getenv("LOG_FORMAT", "text").lower() == "json",
+        rotate=os.getenv("LOG_ROTATE", "size").lower(),
+        max_bytes=int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024))),
+        backup_count=int(os.getenv("LOG_BACKUPS", "5")),
+    )
@@ -0,0 +1,178 @@
+"""
+Discord Webhook 推播：共用一個連線池（requests.Session），把多則訊息打包成最少的 POST，
+並依 Discord 回傳的 rate limit 標頭等待，取代每則訊息後固定 sleep 1 秒。
+"""
+import json
+import time
+
+CONTENT_LIMIT = 2000            # 一般訊息 content 上限
+EMBEDS_PER_MESSAGE = 10         # 每次 POST 最多 10 個 embed
+EMBED_DESCRIPTION_LIMIT = 4096  # 單一 embed description 上限
+EMBED_TOTAL_LIMIT = 6000        # 同一則訊息所有 embed 文字總和上限
+MESSAGE_SEPARATOR = "\n"
+
+
+def split_message(message, limit=CONTENT_LIMIT):
+    """超過上限的單則訊息依換行切段；單行仍過長時硬切。"""
+    if len(message) <= limit:
+        return [message]
+    chunks, current = [], ""
+    for line in message.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def pack_contents(messages, limit=CONTENT_LIMIT):
+    """把多則訊息依序合併成數個不超過 limit 字元的 content。"""
+    packed, current = [], ""
+    for message in messages:
+        for chunk in split_message(message, limit):
+            candidate = f"{current}{MESSAGE_SEPARATOR}{chunk}" if current else chunk
+            if len(candidate) > limit:
+                packed.append(current)
+                current = chunk
+            else:
+                current = candidate
+    if current:
+        packed.append(current)
+    return packed
+
+
+def pack_embeds(messages):
+    """每則訊息一個 embed，依 10 個／6000 字的限制分組，回傳每次 POST 的 embed 清單。"""
+    batches, current, total = [], [], 0
+    for message in messages:
+        for chunk in split_message(message, EMBED_DESCRIPTION_LIMIT):
+            if current and (len(current) >= EMBEDS_PER_MESSAGE or total + len(chunk) > EMBED_TOTAL_LIMIT):
+                batches.append(current)
+                current, total = [], 0
+            current.append({"description": chunk})
+            total += len(chunk)
+    if current:
+        batches.append(current)
+    return batches
+
+
+class DiscordNotifier:
+    def __init__(self, webhook_url, use_embeds=False, max_retries=3, timeout=10, log=print,
+                 session=None, tracer=None):
+        self.webhook_url = webhook_url
+        self.use_embeds = use_embeds
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.log = log
+        self._session = session
+        self.tracer = tracer
+        self._pending = []
+        self._blocked_until = 0.0  # 依 X-RateLimit-* 標頭推算，下一次可送出的時間
+        self.posts = 0
+
+    @property
+    def session(self):
+        """第一次推播時才建立連線池（import requests 約 0.1 秒，休市日直接結束的執行不需要）。"""
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+
+    def queue(self, message):
+        """先排入佇列，flush() 時再合併送出。"""
+        self._pending.append(message)
+
+    def discard(self):
+        """捨棄尚未送出的訊息（例如本批次沒有任何需要推播的內容）。"""
+        self._pending = []
+
+    def send(self, message):
+        """立即送出（仍會依長度切段），用於警告等不需要等批次的訊息。"""
+        return self._deliver([message])
+
+    def flush(self):
+        messages, self._pending = self._pending, []
+        if not messages:
+            return True
+        return self._deliver(messages)
+
+    def _deliver(self, messages):
+        if not self.webhook_url:
+            self.log("未設定 DISCORD_WEBHOOK_URL，無法推播 Discord。")
+            return False
+        if self.use_embeds:
+            payloads = [{"embeds": embeds} for embeds in pack_embeds(messages)]
+        else:
+            payloads = [{"content": content} for content in pack_contents(messages)]
+        ok = True
+        for payload in payloads:
+            ok = self._post(payload) and ok
+        self.log(f"Discord 推播 {len(messages)} 則訊息，合併為 {len(payloads)} 次請求")
+        return ok
+
+    def _respect_rate_limit(self, resp):
+        """記錄 bucket 剩餘次數；用完時等到 reset 再送下一則。"""
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        reset_after = resp.headers.get("X-RateLimit-Reset-After")
+        if remaining == "0" and reset_after:
+            try:
+                self._blocked_until = time.monotonic() + float(reset_after)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _retry_after(resp):
+        """429 時的等待秒數：優先 Retry-After 標頭，其次 JSON 的 retry_after。"""
+        value = resp.headers.get("Retry-After")
+        if value is None:
+            try:
+                value = resp.json().get("retry_after")
+            except ValueError:
+                value = None
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            return 1.0
+
+    def _send_once(self, payload, attempt):
+        if not self.tracer:
+            return self.session.post(self.webhook_url, json=payload, timeout=self.timeout)
+        with self.tracer.trace("discord", "webhook_post") as span:
+            span["retries"] = attempt
+            resp = self.session.post(self.webhook_url, json=payload, timeout=self.timeout)
+            span["bytes"] = len(json.dumps(payload, ensure_ascii=False).encode()) + len(resp.content or b"")
+            span["ok"] = resp.status_code in (200, 204)
+            return resp
+
+    def _post(self, payload):
+        for attempt in range(self.max_retries + 1):
+            wait = self._blocked_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                resp = self._send_once(payload, attempt)
+            except Exception as e:
+                self.log(f"Discord 推播失敗：{e}")
+                return False
+            self.posts += 1
+            self._respect_rate_limit(resp)
+            if resp.status_code in (200, 204):
+                return True
+            if resp.status_code == 429 and attempt < self.max_retries:
+                retry_after = self._retry_after(resp)
+                self.log(f"Discord rate limit，{retry_after:.2f} 秒後重試（第 {attempt + 1} 次）")
+                self._blocked_until = time.monotonic() + retry_after
+                continue
+            self.log(f"Discord 推播失敗，狀態碼：{resp.status_code}，回應：{resp.text}")
+            return False
+        return False
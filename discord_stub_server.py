@@ -0,0 +1,71 @@
+"""
+本機 Discord Webhook 模擬伺服器，測試推播打包與 rate limit 處理用，不會真的發到 Discord。
+
+    python discord_stub_server.py --port 8765 --rate-limit-every 5
+    DISCORD_WEBHOOK_URL=http://127.0.0.1:8765/webhook python stock-multi-notify.py
+
+每次收到 POST 會印出內容長度；--rate-limit-every N 表示每第 N 次請求回 429 + Retry-After。
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with server.lock:
+            server.request_count += 1
+            count = server.request_count
+        limited = server.rate_limit_every and count % server.rate_limit_every == 0
+        if limited:
+            body = json.dumps({"message": "You are being rate limited.", "retry_after": server.retry_after}).encode()
+            self.send_response(429)
+            self.send_header("Retry-After", str(server.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        with server.lock:
+            server.received.append(payload)
+        if server.verbose:
+            size = len(payload.get("content") or "") + sum(len(e.get("description", "")) for e in payload.get("embeds", []))
+            print(f"#{count} 收到推播：{size} 字元，{len(payload.get('embeds', []))} 個 embed")
+        self.send_response(204)
+        self.send_header("X-RateLimit-Remaining", "4")
+        self.send_header("X-RateLimit-Reset-After", "1")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port=0, rate_limit_every=0, retry_after=0.1, verbose=False):
+    """在背景執行緒啟動模擬伺服器，回傳 (server, webhook_url)；收到的 payload 在 server.received。"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _StubHandler)
+    server.lock = threading.Lock()
+    server.received = []
+    server.request_count = 0
+    server.rate_limit_every = rate_limit_every
+    server.retry_after = retry_after
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/webhook"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本機 Discord Webhook 模擬伺服器")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="每第 N 次請求回 429（0=不模擬）")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 時的 Retry-After 秒數")
+    args = parser.parse_args()
+    stub, url = start_stub_server(args.port, args.rate_limit_every, args.retry_after, verbose=True)
+    print(f"Discord stub webhook 啟動：{url}（Ctrl+C 結束）")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -0,0 +1,64 @@
+"""
+單次執行內的 FinMind 日K快取：包裝 DataLoader，同一支股票重疊的日期區間只下載一次，
+之後的子區間直接從記憶體篩出；並統計命中／實際呼叫次數，確認每支股票只花一次日K請求。
+"""
+import threading
+from collections import defaultdict
+
+
+class CachedDataLoader:
+    def __init__(self, dl, tracer=None):
+        self._dl = dl
+        self._tracer = tracer
+        self._ranges = {}   # stock_id → (start, end, DataFrame)
+        self._locks = defaultdict(threading.Lock)
+        self._locks_guard = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def __getattr__(self, name):
+        # 其他 DataLoader 方法（login_by_token、get_data…）直接轉給原物件
+        return getattr(self._dl, name)
+
+    def _lock_for(self, stock_id):
+        with self._locks_guard:
+            return self._locks[stock_id]
+
+    def _fetch(self, stock_id, start_date, end_date):
+        """實際呼叫 FinMind；已有快取時合併成涵蓋新舊區間的一次下載。"""
+        cached = self._ranges.get(stock_id)
+        if cached:
+            start_date = min(start_date, cached[0])
+            end_date = max(end_date, cached[1])
+        self.misses[stock_id] += 1
+        df = self._dl.taiwan_stock_daily(stock_id, start_date=start_date, end_date=end_date)
+        self._ranges[stock_id] = (start_date, end_date, df)
+        return df
+
+    def prefetch(self, stock_id, start_date, end_date):
+        """預先下載本次執行會用到的最大區間，之後的查詢都從快取取得。"""
+        with self._lock_for(stock_id):
+            cached = self._ranges.get(stock_id)
+            if cached and cached[0] <= start_date and end_date <= cached[1]:
+                return
+            self._fetch(stock_id, start_date, end_date)
+
+    def taiwan_stock_daily(self, stock_id, start_date, end_date=None):
+        end_date = end_date or start_date
+        with self._lock_for(stock_id):
+            cached = self._ranges.get(stock_id)
+            if cached and cached[0] <= start_date and end_date <= cached[1]:
+                self.hits[stock_id] += 1
+                if self._tracer:
+                    self._tracer.record("finmind", "taiwan_stock_daily", stock_id, cache_hit=True)
+                df = cached[2]
+            else:
+                df = self._fetch(stock_id, start_date, end_date)
+        if df is None or df.empty:
+            return df
+        mask = (df["date"] >= start_date) & (df["date"] <= end_date)
+        return df.loc[mask].reset_index(drop=True)
+
+    def stats(self):
+        """回傳 (命中次數, 實際呼叫次數, {stock_id: 實際呼叫次數})。"""
+        return sum(self.hits.values()), sum(self.misses.values()), dict(self.misses)
@@ -0,0 +1,39 @@
+"""
+本機快取目錄與 JSON 狀態檔的共用工具。
+目錄預設為 ./.stock_cache，可用環境變數 STOCK_CACHE_DIR 指定（例如 Render 的持久磁碟路徑）。
+"""
+import json
+import os
+
+CACHE_DIR = os.getenv("STOCK_CACHE_DIR", ".stock_cache")
+
+
+def cache_path(*parts):
+    """回傳快取目錄下的路徑，並確保上層資料夾存在。"""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def cache_dir(*parts):
+    """回傳快取目錄下的子資料夾，不存在時自動建立。"""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_json(path, default=None):
+    """讀取 JSON 檔，不存在或損毀時回傳 default。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """先寫暫存檔再 os.replace，避免程式中斷時留下寫一半的檔案。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,118 @@
+"""
+均線（MA）計算模組，兩支程式共用：
+- rolling_ma / moving_averages：整段收盤價用一次累積和算出每一天的 MA
+- StreamingMA / MATracker：環形緩衝區，新增一筆價格即可 O(1) 取得新均線
+"""
+import math
+
+import numpy as np
+
+DEFAULT_WINDOWS = (5, 20, 60)
+
+
+def rolling_ma(closes, window):
+    """回傳與 closes 等長的 MA 陣列，前 window-1 筆資料不足的位置為 NaN。"""
+    arr = np.asarray(closes, dtype=float)
+    out = np.full(arr.shape, np.nan)
+    if window <= 0 or len(arr) < window:
+        return out
+    csum = np.concatenate(([0.0], np.cumsum(arr)))
+    out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+
+def moving_averages(closes, windows=DEFAULT_WINDOWS):
+    """一次算出多個視窗的 MA 陣列：{window: ndarray}。"""
+    arr = np.asarray(closes, dtype=float)
+    return {window: rolling_ma(arr, window) for window in windows}
+
+
+def latest_ma(closes, window):
+    """只取最後一天的 MA，資料不足回傳 None。"""
+    if window <= 0 or len(closes) < window:
+        return None
+    return float(np.mean(np.asarray(closes[-window:], dtype=float)))
+
+
+def ma_or_none(value):
+    """NaN → None，方便直接寫入 Sheets 或格式化顯示。"""
+    if value is None:
+        return None
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+class StreamingMA:
+    """單一視窗的串流 MA：環形緩衝區 + 累計和，每筆更新 O(1)。"""
+
+    def __init__(self, window):
+        self.window = window
+        self._buf = [0.0] * window
+        self._pos = 0
+        self._count = 0
+        self._sum = 0.0
+
+    def push(self, value):
+        value = float(value)
+        self._sum += value - self._buf[self._pos]
+        self._buf[self._pos] = value
+        self._pos = (self._pos + 1) % self.window
+        if self._count < self.window:
+            self._count += 1
+        if self._pos == 0:
+            # 每繞一圈重新加總一次，避免浮點誤差累積（攤提後仍為 O(1)）
+            self._sum = sum(self._buf)
+        return self.value()
+
+    def value(self):
+        if self._count < self.window:
+            return None
+        return self._sum / self.window
+
+    def peek(self, value):
+        """假設再加入 value 時的 MA，不改變狀態（盤中即時價試算用）。"""
+        if self._count + 1 < self.window:
+            return None
+        dropped = self._buf[self._pos] if self._count == self.window else 0.0
+        return (self._sum - dropped + float(value)) / self.window
+
+
+class MATracker:
+    """每支股票各自保存 MA5/MA20/MA60（或自訂視窗）的串流狀態。"""
+
+    def __init__(self, windows=DEFAULT_WINDOWS):
+        self.windows = tuple(windows)
+        self._states = {}
+
+    def seed(self, stock_id, closes):
+        """用歷史收盤價重建某支股票的狀態（只需最後 max(window) 筆）。"""
+        states = {window: StreamingMA(window) for window in self.windows}
+        tail = list(closes[-max(self.windows):]) if len(closes) else []
+        for price in tail:
+            for state in states.values():
+                state.push(price)
+        self._states[stock_id] = states
+        return self.values(stock_id)
+
+    def has(self, stock_id):
+        return stock_id in self._states
+
+    def push(self, stock_id, price):
+        """加入一筆新收盤價並回傳新的 {window: MA}。"""
+        states = self._states.setdefault(
+            stock_id, {window: StreamingMA(window) for window in self.windows}
+        )
+        return {window: state.push(price) for window, state in states.items()}
+
+    def values(self, stock_id):
+        states = self._states.get(stock_id)
+        if not states:
+            return {window: None for window in self.windows}
+        return {window: state.value() for window, state in states.items()}
+
+    def peek(self, stock_id, price):
+        """以盤中即時價試算 MA，不寫入狀態。"""
+        states = self._states.get(stock_id)
+        if not states:
+            return {window: None for window in self.windows}
+        return {window: state.peek(price) for window, state in states.items()}
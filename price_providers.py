@@ -0,0 +1,330 @@
+"""
+即時價格來源（provider）與 hedged 解析器：
+- 每個來源實作 fetch(stock_id, today)，回傳價格資訊 dict（price、time、source、is_latest、finmind_success），
+  取不到回傳 None；FinMind 即時價、FinMind 當天日K、yfinance 與測試用的 FakeProvider 都是同一介面
+- HedgedResolver 依序啟動來源：前一個來源超過 hedge 延遲仍未回應就同時啟動下一個，
+  前一個回傳無資料則立刻換下一個，先取得有效價格者為準（落後的請求在背景結束，結果捨棄）
+- hedge 延遲依各來源實際回應時間自動調整（LatencyStats，存於本機快取，cron 模式跨次延續）；
+  來源有 limiter 時先取得 token 才開始計時，本機限流的等待不算來源延遲、也不會觸發 hedge
+- FinMindSnapshot 以一次請求取得整份監控清單的最新價，查不到的股票才逐支走上面的來源
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+from local_cache import cache_path, load_json, save_json
+from rate_limit import is_rate_limited
+
+# FinMind 權限不足（例如免費會員查詢 sponsor 資料集）的回應字樣
+PERMISSION_STATUS = (401, 403)
+PERMISSION_MESSAGES = ("user level", "Your level", "sponsor", "Sponsor", "permission", "Forbidden")
+
+
+def is_permission_denied(exc):
+    """判斷例外是否為帳號權限不足；逾時、連線中斷與 rate limit 都不算（下次仍可能成功）。"""
+    if is_rate_limited(exc):
+        return False
+    resp = getattr(exc, "resp", None) or getattr(exc, "response", None)
+    status = getattr(resp, "status", None) or getattr(resp, "status_code", None)
+    if status in PERMISSION_STATUS:
+        return True
+    return any(text in str(exc) for text in PERMISSION_MESSAGES)
+
+
+class PriceProvider:
+    """價格來源介面；limiter 為該來源請求共用的 RateLimiter（沒有則為 None）。"""
+    name = "provider"
+    limiter = None
+
+    def fetch(self, stock_id, today):
+        raise NotImplementedError
+
+
+class FinMindTickProvider(PriceProvider):
+    """FinMind 當天分鐘價（TaiwanStockPrice）。"""
+    name = "finmind_tick"
+
+    def __init__(self, dl, log=print, limiter=None):
+        self.dl = dl
+        self.log = log
+        self.limiter = limiter
+
+    def fetch(self, stock_id, today):
+        import pandas as pd
+        try:
+            df = self.dl.get_data(dataset="TaiwanStockPrice", data_id=stock_id, start_date=today)
+        except Exception as e:
+            self.log(f"{stock_id} FinMind 當天分鐘價失敗：{e}")
+            return None
+        if df is None or df.empty or "close" not in df.columns:
+            return None
+        latest = df.iloc[-1]
+        time_str = latest["date"]
+        if "Time" in df.columns and pd.notna(latest.get("Time", None)):
+            time_str = f"{latest['date']} {latest['Time']}"
+        price = float(latest["close"])
+        self.log(f"{stock_id} 取得當天最新分鐘價（FinMind）：{price:.2f} @ {time_str}")
+        return {"price": price, "time": time_str, "source": "today_tick_finmind",
+                "is_latest": True, "finmind_success": True}
+
+
+class FinMindDailyProvider(PriceProvider):
+    """FinMind 當天日K（收盤後才有資料）。"""
+    name = "finmind_daily"
+
+    def __init__(self, dl, log=print, limiter=None):
+        self.dl = dl
+        self.log = log
+        self.limiter = limiter
+
+    def fetch(self, stock_id, today):
+        try:
+            df_day = self.dl.taiwan_stock_daily(stock_id, start_date=today, end_date=today)
+        except Exception as e:
+            self.log(f"{stock_id} FinMind 當天日收盤價失敗：{e}")
+            return None
+        if df_day is None or df_day.empty:
+            return None
+        price = float(df_day.iloc[0]["close"])
+        self.log(f"{stock_id} 取得當天日收盤價（FinMind）：{price:.2f}")
+        return {"price": price, "time": f"{today} 收盤", "source": "today_daily_finmind",
+                "is_latest": True, "finmind_success": True}
+
+
+class YFinanceProvider(PriceProvider):
+    """yfinance 備援：依 candidates(stock_id) 逐一嘗試後綴（.TW／.TWO），fetch_suffix(stock_id, suffix) 為實際查詢。"""
+    name = "yfinance"
+
+    def __init__(self, fetch_suffix, candidates):
+        self.fetch_suffix = fetch_suffix
+        self.candidates = candidates
+
+    def fetch(self, stock_id, today):
+        for suffix in self.candidates(stock_id):
+            result = self.fetch_suffix(stock_id, suffix)
+            if result:
+                return result
+        return None
+
+
+class FakeProvider(PriceProvider):
+    """
+    測試用來源（bench_hedge.py）：prices 為 {stock_id: 價格}，可指定延遲與失敗，不連網；
+    指定 limiter 時每次 fetch 先取得 token，與 RateLimited 包裝的 DataLoader 相同。
+    """
+
+    def __init__(self, name, prices, delay=0.0, fail=False, source="fake", limiter=None):
+        self.name = name
+        self.prices = prices
+        self.delay = delay
+        self.fail = fail
+        self.source = source
+        self.limiter = limiter
+        self.calls = 0
+
+    def fetch(self, stock_id, today):
+        if self.limiter:
+            self.limiter.acquire()
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(f"{self.name} 模擬失敗")
+        price = self.prices.get(stock_id)
+        if price is None:
+            return None
+        return {"price": float(price), "time": today, "source": self.source,
+                "is_latest": True, "finmind_success": False}
+
+
+class FinMindSnapshot:
+    """
+    一次取得多支股票的最新價：優先使用即時快照（taiwan_stock_tick_snapshot，限 sponsor 會員），
+    不可用時改用不帶 data_id 的 TaiwanStockPrice 全市場當日資料，在本機篩出監控清單。
+    FinMind 回應權限不足時記在本機快取，當天之後的執行直接略過該請求；逾時、rate limit 等暫時性錯誤
+    只影響這一次。請求數與清單長短無關。
+    """
+    name = "finmind_snapshot"
+
+    def __init__(self, log=print, path=None):
+        self.log = log
+        self.path = path or cache_path("finmind_snapshot.json")
+        data = load_json(self.path, {}) or {}
+        self.tick_unsupported_on = data.get("tick_unsupported_on")
+        self.market_unsupported_on = data.get("market_unsupported_on")
+
+    def _save(self):
+        try:
+            save_json(self.path, {"tick_unsupported_on": self.tick_unsupported_on,
+                                  "market_unsupported_on": self.market_unsupported_on})
+        except OSError:
+            pass
+
+    @staticmethod
+    def _latest_rows(df, stock_ids):
+        if df is None or df.empty or "stock_id" not in df.columns or "close" not in df.columns:
+            return []
+        df = df[df["stock_id"].astype(str).isin(stock_ids)]
+        return df.drop_duplicates("stock_id", keep="last").to_dict("records")
+
+    def _from_tick_snapshot(self, dl, stock_ids, today):
+        try:
+            df = dl.taiwan_stock_tick_snapshot(stock_id=list(stock_ids))
+        except Exception as e:
+            if is_permission_denied(e):
+                self.tick_unsupported_on = today
+                self._save()
+                self.log(f"FinMind 即時快照權限不足（{e}），今天改用全市場當日資料")
+            else:
+                self.log(f"FinMind 即時快照暫時失敗（{e}），本次改用全市場當日資料")
+            return None
+        quotes = {}
+        for row in self._latest_rows(df, stock_ids):
+            price = row.get("close")
+            if price and price == price:  # 排除 0 與 NaN（尚未成交）
+                quotes[str(row["stock_id"])] = {"price": float(price), "time": str(row.get("date", "")),
+                                                "source": "today_tick_finmind", "is_latest": True,
+                                                "finmind_success": True}
+        return quotes
+
+    def _from_market_daily(self, dl, stock_ids, today):
+        import pandas as pd
+        try:
+            df = dl.get_data(dataset="TaiwanStockPrice", start_date=today)
+        except Exception as e:
+            if is_permission_denied(e):
+                self.market_unsupported_on = today
+                self._save()
+                self.log(f"FinMind 全市場當日資料權限不足（{e}），今天改為逐支查詢")
+            else:
+                self.log(f"FinMind 全市場當日資料失敗：{e}")
+            return {}
+        quotes = {}
+        for row in self._latest_rows(df, stock_ids):
+            time_str = row["date"]
+            if pd.notna(row.get("Time", None)):
+                time_str = f"{row['date']} {row['Time']}"
+            quotes[str(row["stock_id"])] = {"price": float(row["close"]), "time": time_str,
+                                            "source": "today_market_finmind", "is_latest": True,
+                                            "finmind_success": True}
+        return quotes
+
+    def fetch_many(self, dl, stock_ids, today):
+        """回傳 {stock_id: 價格資訊}；沒有出現在回應中的股票不在結果內，由呼叫端逐支補查。"""
+        stock_ids = set(stock_ids)
+        if not stock_ids:
+            return {}
+        quotes = None
+        if self.tick_unsupported_on != today:
+            quotes = self._from_tick_snapshot(dl, stock_ids, today)
+        if quotes is None:
+            if self.market_unsupported_on == today:
+                return {}
+            quotes = self._from_market_daily(dl, stock_ids, today)
+        return quotes
+
+
+class LatencyStats:
+    """
+    各來源的回應時間估計（EWMA，與 TCP RTT 估計相同）：hedge 延遲 = 平均 + 4 × 平均偏差，
+    限制在 [min_delay, max_delay]；樣本不足 3 筆時使用 default_delay。
+    """
+    ALPHA = 0.125
+    BETA = 0.25
+    MIN_SAMPLES = 3
+
+    def __init__(self, default_delay, min_delay=0.2, max_delay=10.0, path=None):
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.path = path or cache_path("provider_latency.json")
+        self.stats = load_json(self.path, {}) or {}  # {來源: {"avg": 秒, "dev": 秒, "count": 次數}}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            entry = self.stats.get(name)
+            if not entry:
+                self.stats[name] = {"avg": seconds, "dev": seconds / 2, "count": 1}
+                return
+            entry["dev"] = (1 - self.BETA) * entry["dev"] + self.BETA * abs(seconds - entry["avg"])
+            entry["avg"] = (1 - self.ALPHA) * entry["avg"] + self.ALPHA * seconds
+            entry["count"] += 1
+
+    def hedge_delay(self, name):
+        with self._lock:
+            entry = self.stats.get(name)
+            if not entry or entry["count"] < self.MIN_SAMPLES:
+                return self.default_delay
+            return min(self.max_delay, max(self.min_delay, entry["avg"] + 4 * entry["dev"]))
+
+    def save(self):
+        with self._lock:
+            save_json(self.path, self.stats)
+
+
+class HedgedResolver:
+    """依序啟動價格來源，必要時並行（hedge），回傳第一個有效的價格資訊。"""
+
+    def __init__(self, stats, max_workers=8, log=print):
+        self.stats = stats
+        self.log = log
+        self.hedges = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="price-hedge")
+
+    def _timed(self, provider, stock_id, today, started):
+        """started 為 {"at": 開始時間, "event": Event}：取得限流 token 後才記錄開始時間並通知 resolve()。"""
+        try:
+            with provider.limiter.reserved() if provider.limiter else nullcontext():
+                started["at"] = time.monotonic()
+                started["event"].set()
+                try:
+                    return provider.fetch(stock_id, today)
+                except Exception as e:
+                    self.log(f"{stock_id} {provider.name} 取價異常：{e}")
+                    return None
+                finally:
+                    self.stats.record(provider.name, time.monotonic() - started["at"])
+        finally:
+            if not started["event"].is_set():
+                started["at"] = time.monotonic()
+                started["event"].set()
+
+    def resolve(self, stock_id, today, providers):
+        providers = list(providers)
+        running = {}
+        state = {"next": 0, "current": None, "started": None}
+
+        def launch():
+            provider = providers[state["next"]]
+            state["next"] += 1
+            state["current"] = provider
+            state["started"] = {"at": None, "event": threading.Event()}
+            running[self._pool.submit(self._timed, provider, stock_id, today, state["started"])] = provider
+
+        launch()
+        while running:
+            timeout = None
+            if state["next"] < len(providers):
+                # 還在等本機限流 token 的時間不算，取得 token 後才開始計算 hedge 延遲
+                state["started"]["event"].wait()
+                delay = self.stats.hedge_delay(state["current"].name)
+                timeout = max(0.0, delay - (time.monotonic() - state["started"]["at"]))
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 目前來源超過 hedge 延遲仍未回應 → 同時啟動下一個來源
+                self.hedges += 1
+                self.log(f"{stock_id} {state['current'].name} 超過 {delay:.2f} 秒未回應，"
+                         f"同時改問 {providers[state['next']].name}")
+                launch()
+                continue
+            for future in done:
+                running.pop(future)
+                result = future.result()
+                if result:
+                    return result
+            # 已回應的來源都沒有資料 → 立刻換下一個，不必等 hedge 延遲
+            if state["next"] < len(providers):
+                launch()
+        return None
@@ -0,0 +1,137 @@
+"""
+本機日K收盤價快取：每支股票一個只追加（append-only）的二進位檔，以 numpy.memmap 讀取。
+每次執行只向 FinMind 補抓「最後快取日之後」的資料，均線直接從 memmap 計算，
+不再每 5 分鐘重抓 90 天，也不必把整段歷史載入記憶體。
+"""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from local_cache import cache_dir, load_json, save_json
+
+# date 以 YYYYMMDD 整數儲存，方便比較與二分搜尋
+BAR_DTYPE = np.dtype([("date", "<i4"), ("close", "<f8")])
+DEFAULT_LOOKBACK_DAYS = 90  # 首次建立快取時往回抓的天數（≈63 交易日，足以計算 MA60）
+
+
+def _date_to_int(date_str):
+    return int(date_str.replace("-", ""))
+
+
+def _int_to_date(value):
+    value = int(value)
+    return f"{value // 10000:04d}-{value // 100 % 100:02d}-{value % 100:02d}"
+
+
+class PriceStore:
+    def __init__(self, root=None):
+        self.root = root or cache_dir("prices")
+        os.makedirs(self.root, exist_ok=True)
+
+    def _bars_path(self, stock_id):
+        return os.path.join(self.root, f"{stock_id}.bin")
+
+    def _meta_path(self, stock_id):
+        return os.path.join(self.root, f"{stock_id}.meta.json")
+
+    def load(self, stock_id):
+        """以 memmap 開啟某支股票的日K（唯讀）；無資料回傳空陣列。"""
+        path = self._bars_path(stock_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        count = size // BAR_DTYPE.itemsize  # 若上次寫到一半中斷，忽略不完整的尾端
+        if count == 0:
+            return np.empty(0, dtype=BAR_DTYPE)
+        return np.memmap(path, dtype=BAR_DTYPE, mode="r", shape=(count,))
+
+    def last_date(self, stock_id):
+        bars = self.load(stock_id)
+        return _int_to_date(bars["date"][-1]) if len(bars) else None
+
+    def checked_through(self, stock_id):
+        """已向 FinMind 確認過資料完整的最後日期（含無交易的假日）。"""
+        meta = load_json(self._meta_path(stock_id), {}) or {}
+        return meta.get("checked_through")
+
+    def append(self, stock_id, dates, closes):
+        """追加日K，只寫入比快取最後一天更新的日期；回傳實際寫入筆數。"""
+        bars = self.load(stock_id)
+        last = int(bars["date"][-1]) if len(bars) else 0
+        del bars
+        new = np.array(
+            [(_date_to_int(d), float(c)) for d, c in zip(dates, closes)],
+            dtype=BAR_DTYPE,
+        )
+        new = new[new["date"] > last]
+        if len(new) == 0:
+            return 0
+        new = np.sort(new, order="date")
+        path = self._bars_path(stock_id)
+        valid_size = 0
+        if os.path.exists(path):
+            valid_size = os.path.getsize(path) // BAR_DTYPE.itemsize * BAR_DTYPE.itemsize
+        with open(path, "ab") as f:
+            f.truncate(valid_size)  # 截掉上次中斷留下的不完整尾端再追加
+            f.write(new.tobytes())
+        return len(new)
+
+    def closes(self, stock_id, before=None):
+        """收盤價序列（memmap 視圖）；before 有給時只取該日期之前的資料。"""
+        bars = self.load(stock_id)
+        if before is not None and len(bars):
+            end = np.searchsorted(bars["date"], _date_to_int(before), side="left")
+            bars = bars[:end]
+        return bars["close"]
+
+    def close_on(self, stock_id, date_str):
+        bars = self.load(stock_id)
+        key = _date_to_int(date_str)
+        idx = np.searchsorted(bars["date"], key, side="left")
+        if idx < len(bars) and bars["date"][idx] == key:
+            return float(bars["close"][idx])
+        return None
+
+    def close_before(self, stock_id, date_str):
+        """date_str 之前最近一個交易日的收盤價。"""
+        prior = self.closes(stock_id, before=date_str)
+        return float(prior[-1]) if len(prior) else None
+
+    def pending_range(self, stock_id, today, include_today=True, lookback_days=DEFAULT_LOOKBACK_DAYS):
+        """尚未確認、需要向 FinMind 補抓的 (start, end)；已是最新時回傳 None。"""
+        today_dt = datetime.strptime(today, "%Y-%m-%d")
+        end_dt = today_dt if include_today else today_dt - timedelta(days=1)
+        checked = self.checked_through(stock_id) or self.last_date(stock_id)
+        if checked:
+            start_dt = datetime.strptime(checked, "%Y-%m-%d") + timedelta(days=1)
+        else:
+            start_dt = today_dt - timedelta(days=lookback_days)
+        if start_dt > end_dt:
+            return None
+        return start_dt.strftime("%Y-%m-%d"), end_dt.strftime("%Y-%m-%d")
+
+    def sync(self, dl, stock_id, today, include_today=True, lookback_days=DEFAULT_LOOKBACK_DAYS):
+        """
+        向 FinMind 補抓快取尾端缺少的日K（最多一次 API 呼叫）。
+        - include_today=False（盤中）：只補到昨天，今天日K尚未產生
+        - 已確認過的日期不再重抓；今天的日K要真的抓到才算確認
+        回傳新增筆數；FinMind 失敗時拋出例外，由呼叫端決定如何處理。
+        """
+        pending = self.pending_range(stock_id, today, include_today, lookback_days)
+        if pending is None:
+            return 0
+
+        start, end = pending
+        today_dt = datetime.strptime(today, "%Y-%m-%d")
+        end_dt = datetime.strptime(end, "%Y-%m-%d")
+        df = dl.taiwan_stock_daily(stock_id, start_date=start, end_date=end)
+        added = 0
+        if df is not None and not df.empty:
+            added = self.append(stock_id, df["date"].tolist(), df["close"].tolist())
+
+        # 過去的日期資料已定案；今天的日K要確實存在才標記為已確認
+        if end_dt < today_dt or self.last_date(stock_id) == today:
+            confirmed = end
+        else:
+            confirmed = (today_dt - timedelta(days=1)).strftime("%Y-%m-%d")
+        save_json(self._meta_path(stock_id), {"checked_through": confirmed})
+        return added
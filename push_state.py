@@ -0,0 +1,49 @@
+"""
+盤中推播的變動偵測（本機快取 push_state.json，每天重新開始）：
+- 記錄每支股票今天最後一次推播的價格、均線與建議
+- 價格相對上次推播的變動未超過門檻（PUSH_CHANGE_PCT，%）且建議相同 → 不再推播完整訊息，
+  只列入一行「未變動」摘要
+- 本次的推播內容先暫存，Discord 確定送出後才寫入，送出失敗下次仍視為有變動
+"""
+from local_cache import cache_path, load_json, save_json
+
+
+class PushState:
+    def __init__(self, threshold_pct=0.5, path=None):
+        self.threshold_pct = threshold_pct
+        self.path = path or cache_path("push_state.json")
+        data = load_json(self.path, {}) or {}
+        self.date = data.get("date")
+        self.stocks = data.get("stocks", {})  # stock_id → {"price", "ma5", "ma20", "ma60", "advice", "pushed_at"}
+        self._staged = {}
+
+    def last(self, today, stock_id):
+        """今天上次推播的內容；今天尚未推播過回傳 None。"""
+        if self.date != today:
+            return None
+        return self.stocks.get(stock_id)
+
+    def changed(self, today, stock_id, price, advice):
+        """價格變動超過門檻（門檻 0 表示價格有任何變動）或建議不同才算有變動；今天第一次一律推播。"""
+        last = self.last(today, stock_id)
+        if not last or not last.get("price"):
+            return True
+        if last.get("advice") != advice:
+            return True
+        return abs(price - last["price"]) / last["price"] * 100 > self.threshold_pct
+
+    def stage(self, stock_id, price, ma5, ma20, ma60, advice, pushed_at):
+        self._staged[stock_id] = {"price": price, "ma5": ma5, "ma20": ma20, "ma60": ma60,
+                                  "advice": advice, "pushed_at": pushed_at}
+
+    def commit(self, today):
+        """推播成功送出後才呼叫：把暫存的內容記為今天最後一次推播。"""
+        if self.date != today:
+            self.date = today
+            self.stocks = {}
+        self.stocks.update(self._staged)
+        self._staged = {}
+        save_json(self.path, {"date": self.date, "stocks": self.stocks})
+
+    def discard(self):
+        self._staged = {}
@@ -0,0 +1,147 @@
+"""
+執行緒安全的 token bucket 限流器，讓並行抓資料時各資料來源不超過每秒請求上限。
+遇到 rate limit（429／FinMind 402）時自動降速並讓所有共用者一起暫停，之後逐步恢復原本速率。
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+RATE_LIMIT_STATUS = (402, 429)
+RATE_LIMIT_MESSAGES = ("Too Many Requests", "Rate limited", "upper limit", "RATE_LIMIT_EXCEEDED", "429")
+
+
+class RateLimiter:
+    """
+    每秒補充 rate 個 token，最多累積 burst 個；acquire() 取不到 token 時會等待。
+    backoff() 把速率減半並暫停所有呼叫者，success() 每次恢復上限的 1/10（AIMD）。
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, max_backoff=60.0):
+        self.rate = float(rate)
+        self.max_rate = self.rate
+        self.min_rate = min_rate if min_rate is not None else self.rate / 16
+        self.max_backoff = max_backoff
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._penalty = 0  # 連續遇到 rate limit 的次數
+        self._lock = threading.Lock()
+        self._local = threading.local()  # reserved() 預先取得、尚未使用的 token（每個執行緒各自）
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+    def acquire(self):
+        if getattr(self._local, "reserved", False):
+            self._local.reserved = False
+            return
+        if self.max_rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    @contextmanager
+    def reserved(self):
+        """
+        先等到 token 再進入區塊，區塊內本執行緒的第一次 acquire() 直接使用這個 token；
+        讓呼叫端把本機限流的等待與實際請求的耗時分開計算。
+        """
+        self.acquire()
+        self._local.reserved = True
+        try:
+            yield
+        finally:
+            self._local.reserved = False
+
+    def backoff(self, retry_after=None):
+        """
+        遇到 rate limit：速率減半（不低於 min_rate），所有呼叫者暫停 retry_after 秒；
+        伺服器沒給 retry_after 時依連續次數指數退避（1、2、4… 秒，最多 max_backoff）。回傳暫停秒數。
+        """
+        with self._lock:
+            self._penalty += 1
+            if self.max_rate > 0:
+                self.rate = max(self.min_rate, self.rate / 2)
+            delay = retry_after if retry_after is not None else min(self.max_backoff, 2 ** (self._penalty - 1))
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = 0.0
+            return delay
+
+    def success(self):
+        """請求成功：清除退避次數，速率逐步恢復到原本上限。"""
+        with self._lock:
+            self._penalty = 0
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+def is_rate_limited(exc):
+    """判斷例外是否為 rate limit：HTTP 429／402（FinMind 用量上限），或訊息含相關字樣。"""
+    resp = getattr(exc, "resp", None) or getattr(exc, "response", None)
+    status = getattr(resp, "status", None) or getattr(resp, "status_code", None)
+    if status in RATE_LIMIT_STATUS:
+        return True
+    return any(text in str(exc) for text in RATE_LIMIT_MESSAGES)
+
+
+def _retry_after(exc):
+    """從例外附帶的回應取得 Retry-After 秒數，沒有則回傳 None。"""
+    resp = getattr(exc, "resp", None) or getattr(exc, "response", None)
+    headers = getattr(resp, "headers", resp)
+    try:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        return max(0.0, float(value))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def call_with_backoff(limiter, func, *args, retries=4, log=None, **kwargs):
+    """
+    先向限流器取得 token 再呼叫 func；遇到 rate limit 時讓限流器退避後重試（最多 retries 次），
+    其他例外或重試用完直接拋出。
+    """
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_rate_limited(e):
+                raise
+            delay = limiter.backoff(_retry_after(e))
+            if log:
+                log(f"遇到 rate limit，暫停 {delay:.1f} 秒後重試（第 {attempt + 1} 次）：{e}")
+            continue
+        limiter.success()
+        return result
+
+
+class RateLimited:
+    """包裝任意 client（例如 FinMind DataLoader），每次呼叫其方法前先向限流器取得 token。"""
+
+    def __init__(self, target, limiter):
+        self._target = target
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def limited(*args, **kwargs):
+            self._limiter.acquire()
+            return attr(*args, **kwargs)
+
+        return limited
@@ -0,0 +1,95 @@
+"""
+避免重複執行：本機檔案鎖（fcntl.flock）與執行紀錄（run_ledger.jsonl）。
+- 同一台機器上前一次執行還沒結束時，新的一次可選擇直接略過或等待（排隊）一段時間
+- 每次執行（含被略過的）附加一行 JSON：開始／結束時間、耗時、狀態、等待鎖的秒數
+鎖只在同一台主機（同一個快取目錄）有效；行程結束時作業系統自動釋放，不會留下失效的鎖。
+"""
+import json
+import os
+import time
+from datetime import datetime
+
+from local_cache import cache_path, load_json
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，鎖退化為不生效
+    fcntl = None
+
+
+class RunLock:
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or cache_path(f"{name}.lock")
+        self.acquired = False
+        self.waited = 0.0
+        self._file = None
+
+    def holder(self):
+        """目前持有鎖的執行資訊（pid、開始時間），讀不到回傳 None。"""
+        return load_json(self.path)
+
+    def acquire(self, wait_seconds=0.0, poll=1.0):
+        """取得鎖；wait_seconds > 0 時最多等待這麼久（排隊），取不到回傳 False。"""
+        if fcntl is None:
+            self.acquired = True
+            return True
+        start = time.monotonic()
+        self._file = open(self.path, "a+", encoding="utf-8")
+        while True:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                self.waited = time.monotonic() - start
+                if self.waited >= wait_seconds:
+                    self._file.close()
+                    self._file = None
+                    return False
+                time.sleep(min(poll, wait_seconds - self.waited))
+        self.waited = time.monotonic() - start
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(json.dumps({"pid": os.getpid(),
+                                     "started_at": datetime.now().isoformat(timespec="seconds")}))
+        self._file.flush()
+        self.acquired = True
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self.acquired = False
+
+
+class RunLedger:
+    """執行紀錄（.stock_cache/run_ledger.jsonl，可用 RUN_LEDGER_FILE 指定）。"""
+
+    def __init__(self, script, path=None):
+        self.script = script
+        self.path = path or os.getenv("RUN_LEDGER_FILE") or cache_path("run_ledger.jsonl")
+        self.started_at = None
+        self._t0 = None
+
+    def start(self):
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self._t0 = time.perf_counter()
+
+    def record(self, status, run_id=None, waited=0.0, **fields):
+        """附加一筆紀錄；status 例如 ok／error／skipped。回傳寫入的內容。"""
+        entry = {
+            "script": self.script,
+            "run_id": run_id,
+            "pid": os.getpid(),
+            "started_at": self.started_at or datetime.now().isoformat(timespec="seconds"),
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "seconds": round(max(0.0, time.perf_counter() - self._t0 - waited), 3) if self._t0 is not None else 0.0,
+            "waited_seconds": round(waited, 3),
+            "status": status,
+        }
+        entry.update(fields)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
@@ -0,0 +1,167 @@
+"""
+執行效能紀錄：追蹤每一次對外呼叫（FinMind、yfinance、Google Sheets、Discord）的
+耗時、資料量、重試次數與快取命中，執行結束時輸出一行 JSON 摘要與可附在 Discord 的一行統計。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from local_cache import cache_path
+
+PROVIDER_LABELS = {"finmind": "FinMind", "yfinance": "yfinance", "sheets": "Sheets", "discord": "Discord"}
+
+
+def payload_size(obj):
+    """估算回應資料量（bytes）：DataFrame 取記憶體用量，其他物件取 JSON 長度。"""
+    if obj is None:
+        return 0
+    if hasattr(obj, "memory_usage"):
+        try:
+            return int(obj.memory_usage(index=True, deep=False).sum())
+        except Exception:
+            return 0
+    if isinstance(obj, (bytes, str)):
+        return len(obj)
+    try:
+        return len(json.dumps(obj, ensure_ascii=False, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class RunTracer:
+    def __init__(self, script):
+        self.script = script
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """開始新的一次紀錄（常駐模式每個週期各自一份摘要）。"""
+        with self._lock:
+            self.run_id = uuid.uuid4().hex[:12]
+            self.started_at = datetime.now().isoformat(timespec="seconds")
+            self._t0 = time.perf_counter()
+            self._spans = []
+
+    @contextmanager
+    def trace(self, provider, op, stock_id=None):
+        """包住一次對外呼叫；呼叫端可在 yield 出來的 dict 補上 bytes／retries。"""
+        span = {"provider": provider, "op": op, "stock_id": stock_id,
+                "bytes": 0, "retries": 0, "cache_hit": False, "ok": True}
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span["ok"] = False
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            span["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            with self._lock:
+                self._spans.append(span)
+
+    def record(self, provider, op, stock_id=None, **fields):
+        """記錄不需計時的事件（例如快取命中）。"""
+        span = {"provider": provider, "op": op, "stock_id": stock_id, "bytes": 0,
+                "retries": 0, "cache_hit": False, "ok": True, "latency_ms": 0.0}
+        span.update(fields)
+        with self._lock:
+            self._spans.append(span)
+
+    def summary(self):
+        with self._lock:
+            spans = list(self._spans)
+
+        def bucket():
+            return {"calls": 0, "cache_hits": 0, "errors": 0, "retries": 0,
+                    "bytes": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+        providers = defaultdict(bucket)
+        stocks = defaultdict(bucket)
+        for span in spans:
+            targets = [providers[span["provider"]]]
+            if span["stock_id"]:
+                targets.append(stocks[span["stock_id"]])
+            for agg in targets:
+                if span["cache_hit"]:
+                    agg["cache_hits"] += 1
+                    continue
+                agg["calls"] += 1
+                agg["errors"] += 0 if span["ok"] else 1
+                agg["retries"] += span["retries"]
+                agg["bytes"] += span["bytes"]
+                agg["total_ms"] = round(agg["total_ms"] + span["latency_ms"], 1)
+                agg["max_ms"] = max(agg["max_ms"], span["latency_ms"])
+        slowest = sorted((s for s in spans if not s["cache_hit"]), key=lambda s: -s["latency_ms"])[:5]
+        return {
+            "run_id": self.run_id,
+            "script": self.script,
+            "started_at": self.started_at,
+            "duration_ms": round((time.perf_counter() - self._t0) * 1000, 1),
+            "providers": dict(providers),
+            "stocks": dict(stocks),
+            "slowest": [{k: s[k] for k in ("provider", "op", "stock_id", "latency_ms")} for s in slowest],
+        }
+
+    def footer(self):
+        """一行統計，可附在 Discord 推播最後。"""
+        summary = self.summary()
+        parts = [f"⏱ 本次 {summary['duration_ms'] / 1000:.1f}s"]
+        for provider, agg in summary["providers"].items():
+            label = PROVIDER_LABELS.get(provider, provider)
+            text = f"{label} {agg['calls']} 次 {agg['total_ms'] / 1000:.1f}s"
+            if agg["cache_hits"]:
+                text += f"（快取 {agg['cache_hits']}）"
+            if agg["errors"]:
+                text += f"（失敗 {agg['errors']}）"
+            parts.append(text)
+        return "｜".join(parts)
+
+    def write_summary(self, path=None):
+        """把本次摘要附加到 JSON Lines 檔（預設 .stock_cache/run_metrics.jsonl，可用 RUN_METRICS_FILE 指定）。"""
+        path = path or os.getenv("RUN_METRICS_FILE") or cache_path("run_metrics.jsonl")
+        summary = self.summary()
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+        return summary
+
+
+class Traced:
+    """包裝任意 client（例如 FinMind DataLoader），每次呼叫其方法都記錄一筆 span。"""
+
+    def __init__(self, target, tracer, provider):
+        self._target = target
+        self._tracer = tracer
+        self._provider = provider
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr) or name.startswith("login"):
+            return attr
+
+        def traced(*args, **kwargs):
+            stock_id = kwargs.get("data_id") or kwargs.get("stock_id") or (args[0] if args else None)
+            with self._tracer.trace(self._provider, name, stock_id if isinstance(stock_id, str) else None) as span:
+                result = attr(*args, **kwargs)
+                span["bytes"] = payload_size(result)
+                return result
+
+        return traced
+
+
+def traced_request_builder(tracer):
+    """回傳給 googleapiclient build(requestBuilder=...) 用的 HttpRequest 子類別，每次 execute() 都被記錄。"""
+    from googleapiclient.http import HttpRequest
+
+    class TracedHttpRequest(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            with tracer.trace("sheets", self.methodId) as span:
+                result = super().execute(http=http, num_retries=num_retries)
+                span["bytes"] = len(self.body or "") + payload_size(result)
+                return result
+
+    return TracedHttpRequest
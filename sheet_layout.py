@@ -0,0 +1,282 @@
+"""
+歷史資料的 Sheets 配置：預設所有股票寫在 Sheet1（single）；設定 SHEET_LAYOUT=per_stock 時
+每支股票各自一個分頁（H_2330、H_0050…），讀取單一股票只下載該分頁，不必拉整張 Sheet1 再過濾。
+兩支程式共用分頁命名、欄位格式與建立分頁的邏輯；分頁 sheetId 與已套用的格式版本記在本機快取，
+格式沒變、資料也沒超出已格式化範圍時完全不呼叫 API。
+"""
+import hashlib
+import json
+import os
+import re
+
+from local_cache import cache_path, load_json, save_json
+
+MAIN_SHEET = "Sheet1"
+STOCK_TAB_PREFIX = "H_"
+SHEET_LAYOUT = os.getenv("SHEET_LAYOUT", "single").lower()
+HISTORY_HEADER = ["股票代號", "名稱", "日期", "收盤價", "MA5", "MA20", "MA60", "更新時間"]
+HISTORY_COLUMNS = len(HISTORY_HEADER)
+FORMAT_ROWS = 10000  # 每次格式化涵蓋的列數；資料超出時再往下延伸
+
+
+def is_per_stock():
+    return SHEET_LAYOUT == "per_stock"
+
+
+def stock_tab(stock_id):
+    return f"{STOCK_TAB_PREFIX}{stock_id}"
+
+
+def history_tab(stock_id):
+    """該股票歷史資料所在的分頁名稱。"""
+    return stock_tab(stock_id) if is_per_stock() else MAIN_SHEET
+
+
+def history_range(stock_id, cells="A2:H"):
+    return f"{history_tab(stock_id)}!{cells}"
+
+
+def format_requests(sheet_id, end_row=FORMAT_ROWS):
+    """歷史資料欄位格式：A 欄純文字（防止 0050 被吃成 50），文字靠左（A、B、C、H）、數字靠右（D、E、F、G）。"""
+    requests = [{"repeatCell": {
+        "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": end_row,
+                  "startColumnIndex": 0, "endColumnIndex": 1},
+        "cell": {"userEnteredFormat": {
+            "horizontalAlignment": "LEFT",
+            "numberFormat": {"type": "TEXT"}
+        }},
+        "fields": "userEnteredFormat.horizontalAlignment,userEnteredFormat.numberFormat"
+    }}]
+    for cols, align in (([1, 2, 7], "LEFT"), ([3, 4, 5, 6], "RIGHT")):
+        for col in cols:
+            requests.append({"repeatCell": {
+                "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": end_row,
+                          "startColumnIndex": col, "endColumnIndex": col + 1},
+                "cell": {"userEnteredFormat": {"horizontalAlignment": align}},
+                "fields": "userEnteredFormat.horizontalAlignment"
+            }})
+    return requests
+
+
+# 格式定義的雜湊；改了 format_requests 內容就會變，已格式化的分頁會在下次執行重新套用
+FORMAT_VERSION = hashlib.sha1(json.dumps(format_requests(0), sort_keys=True).encode()).hexdigest()[:12]
+
+
+class SheetState:
+    """
+    本機快取的試算表狀態（.stock_cache/sheet_state.json）：
+    - sheet_ids：{分頁名稱: sheetId}，取代每次 spreadsheets().get
+    - formatted：{分頁名稱: {"version": 格式版本, "through": 已格式化到第幾列}}
+    - rows：{分頁名稱: 已知寫到的最後一列}
+    """
+
+    def __init__(self, spreadsheet_id, path=None):
+        self.spreadsheet_id = spreadsheet_id
+        self.path = path or cache_path("sheet_state.json")
+        data = load_json(self.path, {}) or {}
+        if data.get("spreadsheet_id") != spreadsheet_id:
+            data = {}
+        self.ids = data.get("sheet_ids", {})
+        self.formatted = data.get("formatted", {})
+        self.rows = data.get("rows", {})
+
+    def _save(self):
+        save_json(self.path, {"spreadsheet_id": self.spreadsheet_id, "sheet_ids": self.ids,
+                              "formatted": self.formatted, "rows": self.rows})
+
+    def sheet_ids(self, service, refresh=False):
+        if refresh or not self.ids:
+            self.ids = list_sheets(service, self.spreadsheet_id)
+            self._save()
+        return self.ids
+
+    def sheet_id(self, service, title):
+        """先查快取，找不到（新分頁）才重新讀取一次。"""
+        sheet_id = self.sheet_ids(service).get(title)
+        if sheet_id is None:
+            sheet_id = self.sheet_ids(service, refresh=True).get(title)
+        return sheet_id
+
+    def add_sheets(self, created):
+        self.ids.update(created)
+        self._save()
+
+    def forget(self):
+        """batchUpdate 失敗（分頁可能被刪除或重建）時清掉快取，下次重新讀取。"""
+        self.ids = {}
+        self.formatted = {}
+        self._save()
+
+    def note_rows(self, title, last_row):
+        if last_row and last_row > self.rows.get(title, 0):
+            self.rows[title] = last_row
+            self._save()
+
+    def needs_format(self, title):
+        done = self.formatted.get(title)
+        return not done or done.get("version") != FORMAT_VERSION or self.rows.get(title, 0) >= done.get("through", 0)
+
+    def mark_formatted(self, title, through):
+        self.formatted[title] = {"version": FORMAT_VERSION, "through": through}
+        self._save()
+
+
+def format_end_row(known_rows):
+    """格式化範圍：至少 FORMAT_ROWS 列，資料接近上限時以 FORMAT_ROWS 為單位往下延伸。"""
+    return (known_rows // FORMAT_ROWS + 1) * FORMAT_ROWS
+
+
+def apply_formatting(service, state, titles, log=print):
+    """只對格式版本不同或資料超出已格式化範圍的分頁送出 repeatCell，回傳實際格式化的分頁清單。"""
+    targets = [t for t in titles if state.needs_format(t)]
+    if not targets:
+        return []
+    requests, ends = [], {}
+    for title in targets:
+        sheet_id = state.sheet_id(service, title)
+        if sheet_id is None:
+            log(f"⚠️ 無法取得 {title} ID，跳過格式套用")
+            continue
+        ends[title] = format_end_row(state.rows.get(title, 0))
+        requests.extend(format_requests(sheet_id, ends[title]))
+    if not requests:
+        return []
+    try:
+        service.spreadsheets().batchUpdate(
+            spreadsheetId=state.spreadsheet_id,
+            body={"requests": requests}
+        ).execute()
+    except Exception:
+        state.forget()
+        raise
+    for title, end_row in ends.items():
+        state.mark_formatted(title, end_row)
+    return list(ends)
+
+
+def last_row_of_range(a1_range):
+    """從 append 回傳的 'Sheet1!A120:H131' 取出最後一列 131，解析失敗回傳 None。"""
+    match = re.search(r"(\d+)$", a1_range or "")
+    return int(match.group(1)) if match else None
+
+
+def list_sheets(service, spreadsheet_id):
+    """回傳 {分頁名稱: sheetId}。"""
+    spreadsheet = service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties(title,sheetId)"
+    ).execute()
+    return {s["properties"]["title"]: s["properties"]["sheetId"] for s in spreadsheet.get("sheets", [])}
+
+
+def to_row_data(row):
+    """把一列值轉成 updateCells／appendCells 用的 RowData；數字保留為數字，其餘存成文字。"""
+    cells = []
+    for value in row:
+        if value is None or value == "":
+            cells.append({})
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append({"userEnteredValue": {"numberValue": value}})
+        else:
+            cells.append({"userEnteredValue": {"stringValue": str(value)}})
+    return {"values": cells}
+
+
+def append_history_rows(service, state, rows):
+    """
+    把多支股票的資料列一次附加到歷史分頁：single 配置一次 values.append 到 Sheet1，
+    per_stock 配置一次 batchUpdate（appendCells）附加到各股分頁；並更新本機記錄的最後一列。
+    """
+    if not rows:
+        return 0
+    if not is_per_stock():
+        result = service.spreadsheets().values().append(
+            spreadsheetId=state.spreadsheet_id,
+            range=f"{MAIN_SHEET}!A2",
+            valueInputOption="RAW",
+            body={"values": rows}
+        ).execute()
+        state.note_rows(MAIN_SHEET, last_row_of_range(result.get("updates", {}).get("updatedRange")))
+        return len(rows)
+
+    rows_by_tab = {}
+    for row in rows:
+        rows_by_tab.setdefault(stock_tab(row[0]), []).append(row)
+    requests = []
+    for title, tab_rows in rows_by_tab.items():
+        sheet_id = state.sheet_id(service, title)
+        if sheet_id is None:
+            raise KeyError(f"找不到分頁 {title}")
+        requests.append({"appendCells": {
+            "sheetId": sheet_id,
+            "rows": [to_row_data(r) for r in tab_rows],
+            "fields": "userEnteredValue"
+        }})
+    service.spreadsheets().batchUpdate(
+        spreadsheetId=state.spreadsheet_id,
+        body={"requests": requests}
+    ).execute()
+    for title, tab_rows in rows_by_tab.items():
+        if title in state.rows:
+            state.note_rows(title, state.rows[title] + len(tab_rows))
+    return len(rows)
+
+
+def new_tab_requests(stock_rows, existing_ids, header=None):
+    """
+    為每支股票建立分頁的 batchUpdate 請求：addSheet（自行指定 sheetId，才能在同一批套格式）、
+    標題列與資料列（appendCells）、欄位格式。stock_rows 為 {stock_id: [資料列]}。
+    回傳 (requests, {分頁名稱: sheetId})。
+    """
+    header = header or HISTORY_HEADER
+    next_id = max(existing_ids, default=0) + 1
+    requests, created = [], {}
+    for stock_id, rows in stock_rows.items():
+        title = stock_tab(stock_id)
+        sheet_id = next_id
+        next_id += 1
+        created[title] = sheet_id
+        requests.append({"addSheet": {"properties": {
+            "sheetId": sheet_id,
+            "title": title,
+            "gridProperties": {"rowCount": max(1000, len(rows) + 100), "columnCount": HISTORY_COLUMNS,
+                               "frozenRowCount": 1}
+        }}})
+        requests.append({"appendCells": {
+            "sheetId": sheet_id,
+            "rows": [to_row_data(header)] + [to_row_data(r) for r in rows],
+            "fields": "userEnteredValue"
+        }})
+        requests.extend(format_requests(sheet_id, format_end_row(len(rows) + 1)))
+    return requests, created
+
+
+def create_stock_tabs(service, state, stock_rows, header=None):
+    """以一次 batchUpdate 建立股票分頁（含資料列與格式），並更新本機的 sheetId／格式紀錄。"""
+    requests, created = new_tab_requests(stock_rows, state.sheet_ids(service).values(), header)
+    service.spreadsheets().batchUpdate(
+        spreadsheetId=state.spreadsheet_id,
+        body={"requests": requests}
+    ).execute()
+    state.add_sheets(created)
+    for stock_id, rows in stock_rows.items():
+        state.note_rows(stock_tab(stock_id), len(rows) + 1)
+        state.mark_formatted(stock_tab(stock_id), format_end_row(len(rows) + 1))
+    return created
+
+
+def ensure_stock_tabs(service, state, stock_ids, log=print):
+    """
+    per_stock 配置下補建缺少的股票分頁（一次 batchUpdate），回傳 {分頁名稱: sheetId}；
+    single 配置不做任何事並回傳 None。分頁清單先查本機快取，有缺才重新讀取。
+    """
+    if not is_per_stock():
+        return None
+    sheets = state.sheet_ids(service)
+    if any(stock_tab(s) not in sheets for s in stock_ids):
+        sheets = state.sheet_ids(service, refresh=True)
+    missing = [s for s in stock_ids if stock_tab(s) not in sheets]
+    if missing:
+        create_stock_tabs(service, state, {s: [] for s in missing})
+        log(f"已建立 {len(missing)} 個股票分頁：{missing}")
+    return state.ids
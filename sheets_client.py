@@ -0,0 +1,87 @@
+"""
+Google Sheets 連線：兩支程式共用。
+- discovery 文件直接使用套件內建的靜態檔（static_discovery），不必每次向 Google 下載
+- access token 存在本機快取（權限 0600），有效期間內重用，不必每次執行都重新換發
+- 整次執行共用同一個 AuthorizedHttp（httplib2 保持連線），所有 Sheets 呼叫走同一條連線
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from local_cache import cache_path, load_json
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+TOKEN_MARGIN = timedelta(minutes=5)  # 到期前 5 分鐘就視為過期，避免執行途中失效
+HTTP_TIMEOUT = 60
+
+
+def _utcnow():
+    """google-auth 的 expiry 為 naive UTC 時間，比較時用同樣格式。"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _token_path(credentials_info):
+    """依服務帳號與 scope 區分快取檔，換帳號時不會誤用舊 token。"""
+    key = hashlib.sha1(f"{credentials_info.get('client_email')}|{' '.join(SCOPES)}".encode()).hexdigest()[:12]
+    return cache_path(f"sheets_token_{key}.json")
+
+
+def _load_cached_token(credentials, path):
+    """快取的 token 還在有效期內就直接套用到 credentials（不發任何網路請求）。"""
+    data = load_json(path)
+    if not data or not data.get("token") or not data.get("expiry"):
+        return False
+    try:
+        expiry = datetime.fromisoformat(data["expiry"])  # google-auth 使用 naive UTC 時間
+    except ValueError:
+        return False
+    if expiry - TOKEN_MARGIN <= _utcnow():
+        return False
+    credentials.token = data["token"]
+    credentials.expiry = expiry
+    return True
+
+
+def _save_token(credentials, path):
+    """token 屬機密資料：以 0600 權限建立暫存檔再 os.replace。"""
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"token": credentials.token, "expiry": credentials.expiry.isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+def ensure_token(credentials, path, log=print):
+    """token 過期或即將過期時重新換發並寫回快取；仍有效時什麼都不做。"""
+    if credentials.valid and credentials.expiry and credentials.expiry - TOKEN_MARGIN > _utcnow():
+        return False
+    from google.auth.transport.requests import Request
+    credentials.refresh(Request())
+    try:
+        _save_token(credentials, path)
+    except OSError as e:
+        log(f"⚠️ Sheets token 快取寫入失敗：{e}")
+    return True
+
+
+def build_sheets_service(credentials_json, request_builder=None, log=print):
+    """建立 Sheets service；回傳 (service, credentials, token 快取路徑)，供長時間執行時再次 ensure_token。"""
+    import google_auth_httplib2
+    import httplib2
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    from googleapiclient.http import HttpRequest
+
+    credentials_info = json.loads(credentials_json)
+    credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
+    token_path = _token_path(credentials_info)
+    if _load_cached_token(credentials, token_path):
+        log("Sheets token 沿用本機快取")
+    else:
+        ensure_token(credentials, token_path, log=log)
+
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    service = build("sheets", "v4", http=http, static_discovery=True, cache_discovery=False,
+                    requestBuilder=request_builder or HttpRequest)
+    return service, credentials, token_path
@@ -1,3 +1,4 @@
+import argparse
 import os
 import re
 import sys
@@ -6,14 +7,23 @@ load_dotenv()
 
 sys.stdout.reconfigure(encoding='utf-8')
 
-import json
-import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-import pandas as pd
 from FinMind.data import DataLoader
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gc
+
+from backfill_checkpoint import BackfillCheckpoint
+from buffered_log import create_logger
+from moving_average import MATracker, ma_or_none
+from rate_limit import RateLimiter, call_with_backoff
+from sheet_layout import (MAIN_SHEET, STOCK_TAB_PREFIX, SheetState, apply_formatting, create_stock_tabs,
+                          ensure_stock_tabs, history_range, history_tab, is_per_stock, stock_tab,
+                          to_row_data)
+from run_guard import RunLedger, RunLock
+from run_metrics import RunTracer, Traced, traced_request_builder
+from sheets_client import build_sheets_service
+from trading_calendar import TradingCalendar
 
 # ======================== 環境變數 ========================
 GOOGLE_SHEETS_CREDENTIALS = os.getenv("GOOGLE_SHEETS_CREDENTIALS")
@@ -40,30 +50,40 @@ STOCK_NAME_MAP = {
     "2231": "為升"
 }
 
-SHEET_NAME = "Sheet1"
+SHEET_NAME = MAIN_SHEET
 CONFIG_SHEET_NAME = "Config"
 
-# 關鍵參數：Render 512MiB 安全設定
-BATCH_DAYS = 90           # 90天≈63交易日，足以計算MA60
-SLEEP_BETWEEN_STOCKS = 60   # 每支股票處理完休息 60 秒
-SLEEP_BETWEEN_WRITES = 8    # 每寫 8 筆休息一次（防 Google API 限流）
+# 本次執行的對外呼叫紀錄（FinMind、Sheets 耗時與資料量），結束時寫入 run_metrics.jsonl
+TRACER = RunTracer("stock-history-fill")
+
+# 分頁 sheetId 與格式套用紀錄（本機快取），避免每次都 spreadsheets().get 與重套格式
+SHEET_STATE = SheetState(GOOGLE_SHEET_ID)
+
+# 關鍵參數：分段下載、逐段寫入，記憶體只與 CHUNK_DAYS 有關，與補齊區間長短無關
+BATCH_DAYS = 90           # 未指定 --start 時補齊最近 90 天
+CHUNK_DAYS = int(os.getenv("CHUNK_DAYS", "365"))  # 每次向 FinMind 下載的天數
+WRITE_BATCH_ROWS = 2000   # 待寫入資料累積到此筆數就先寫出
+MA_WARMUP_DAYS = 120      # 區間開始前多抓的天數（≈80 交易日），讓第一天就有 MA60
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "0"))  # 每支股票保留的最新筆數，0 表示不清理
+# 並行補齊：同時處理的股票數；所有 worker 共用同一個 FinMind／Sheets 限流器，遇到 429 自動退避
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+FINMIND_RATE_LIMITER = RateLimiter(float(os.getenv("FINMIND_REQUESTS_PER_SEC", "5")), burst=BACKFILL_WORKERS)
+SHEETS_RATE_LIMITER = RateLimiter(float(os.getenv("SHEETS_WRITES_PER_MIN", "60")) / 60)  # Sheets 每分鐘寫入配額
+BACKFILL_REQUEST_BUDGET = int(os.getenv("BACKFILL_REQUEST_BUDGET", "0"))  # 單次執行的 FinMind 請求上限，0 表示不限
 
 # ======================== 工具函式 ========================
-def write_log(msg):
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open("error.log", "a", encoding="utf-8") as f:
-        f.write(f"{now_str} {msg}\n")
-    print(f"{now_str} {msg}")
+# 背景執行緒批次寫入 error.log（支援 JSON 與輪替），程式結束時自動寫完
+LOGGER = create_logger('%Y-%m-%d %H:%M:%S')
+
+
+def write_log(msg, **fields):
+    LOGGER.log(msg, **fields)
 
 def get_sheets_service():
+    """內建 discovery 文件 + 本機快取的 token：token 仍有效時建立連線不需任何網路往返。"""
     try:
-        creds_json = GOOGLE_SHEETS_CREDENTIALS
-        credentials_info = json.loads(creds_json)
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_info,
-            scopes=["https://www.googleapis.com/auth/spreadsheets"]
-        )
-        service = build("sheets", "v4", credentials=credentials)
+        service, _, _ = build_sheets_service(GOOGLE_SHEETS_CREDENTIALS, traced_request_builder(TRACER),
+                                             log=write_log)
         write_log("✅ Google Sheets 連線成功")
         return service
     except Exception as e:
@@ -71,11 +91,9 @@ def get_sheets_service():
         return None
 
 def get_sheet_id(service, sheet_name):
+    """sheetId 先查本機快取（SHEET_STATE），沒有才呼叫 spreadsheets().get。"""
     try:
-        spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
-        for sheet in spreadsheet["sheets"]:
-            if sheet["properties"]["title"] == sheet_name:
-                return sheet["properties"]["sheetId"]
+        return SHEET_STATE.sheet_id(service, sheet_name)
     except Exception as e:
         write_log(f"取得 sheet ID 失敗：{e}")
     return None
@@ -101,48 +119,24 @@ def reset_sheet_filter(service):
         ).execute()
         write_log("✅ Sheet1 篩選器重設完成")
     except Exception as e:
+        SHEET_STATE.forget()
         write_log(f"⚠️ 篩選器重設失敗：{e}")
 
 
-def apply_sheet_formatting(service):
-    """套用 Sheet1 欄位格式：文字靠左（A、B、C、H）、數字靠右（D、E、F、G）"""
-    sheet_id = get_sheet_id(service, SHEET_NAME)
-    if sheet_id is None:
-        write_log("⚠️ 無法取得 Sheet1 ID，跳過格式套用")
-        return
+def apply_sheet_formatting(service, stock_ids):
+    """
+    套用歷史資料欄位格式：文字靠左（A、B、C、H）、數字靠右（D、E、F、G）。
+    只在格式版本改變或資料超出已格式化範圍時才送出，否則不呼叫任何 API。
+    """
+    titles = list(dict.fromkeys(history_tab(s) for s in stock_ids))
     try:
-        requests = []
-        # A欄（股票代號）→ 純文字格式，防止 0050 被吃成 50
-        requests.append({"repeatCell": {
-            "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 10000,
-                      "startColumnIndex": 0, "endColumnIndex": 1},
-            "cell": {"userEnteredFormat": {
-                "horizontalAlignment": "LEFT",
-                "numberFormat": {"type": "TEXT"}
-            }},
-            "fields": "userEnteredFormat.horizontalAlignment,userEnteredFormat.numberFormat"
-        }})
-        for col in [1, 2, 7]:  # B=名稱, C=日期, H=timestamp → 靠左
-            requests.append({"repeatCell": {
-                "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 10000,
-                          "startColumnIndex": col, "endColumnIndex": col + 1},
-                "cell": {"userEnteredFormat": {"horizontalAlignment": "LEFT"}},
-                "fields": "userEnteredFormat.horizontalAlignment"
-            }})
-        for col in [3, 4, 5, 6]:  # D=收盤價, E=MA5, F=MA20, G=MA60 → 靠右
-            requests.append({"repeatCell": {
-                "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 10000,
-                          "startColumnIndex": col, "endColumnIndex": col + 1},
-                "cell": {"userEnteredFormat": {"horizontalAlignment": "RIGHT"}},
-                "fields": "userEnteredFormat.horizontalAlignment"
-            }})
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body={"requests": requests}
-        ).execute()
-        write_log("✅ Sheet1 欄位格式套用完成")
+        done = apply_formatting(service, SHEET_STATE, titles, log=write_log)
+        if done:
+            write_log(f"✅ {'、'.join(done)} 欄位格式套用完成")
+        else:
+            write_log("欄位格式已是最新，略過套用")
     except Exception as e:
-        write_log(f"⚠️ Sheet1 格式套用失敗：{e}")
+        write_log(f"⚠️ 欄位格式套用失敗：{e}")
 
 
 def load_stock_list_from_sheets(service):
@@ -188,200 +182,619 @@ def load_stock_list_from_sheets(service):
         return None, None
 
 
+def load_sheet_rows(service):
+    """一次讀取 Sheet1 全部資料列（A2:H），整次執行共用，避免每支股票、每一天重複下載。"""
+    result = service.spreadsheets().values().get(
+        spreadsheetId=GOOGLE_SHEET_ID,
+        range=f"{SHEET_NAME}!A2:H"
+    ).execute()
+    return result.get("values", [])
+
+
+def load_history_tabs(service, stock_ids):
+    """
+    讀取各股既有資料，回傳 {分頁名稱: values（A2:H）}：
+    single 配置只讀 Sheet1 一次；per_stock 配置以一次 batchGet 只讀這些股票的分頁。
+    """
+    if not is_per_stock():
+        return {SHEET_NAME: load_sheet_rows(service)}
+    tabs = [history_tab(s) for s in stock_ids]
+    result = service.spreadsheets().values().batchGet(
+        spreadsheetId=GOOGLE_SHEET_ID,
+        ranges=[history_range(s) for s in stock_ids]
+    ).execute()
+    return {tab: vr.get("values", []) for tab, vr in zip(tabs, result.get("valueRanges", []))}
+
+
+def rows_to_history(values, stock_id=None):
+    history = []
+    for row in values:
+        if len(row) >= 4 and (stock_id is None or row[0] == stock_id):
+            try:
+                price = float(row[3]) if row[3] else None
+            except:
+                price = None
+            history.append({
+                "date": row[2],
+                "price": price,
+                "ma5": row[4] if len(row) > 4 else None,
+                "ma20": row[5] if len(row) > 5 else None,
+                "ma60": row[6] if len(row) > 6 else None,
+                "timestamp": row[7] if len(row) > 7 else row[2]
+            })
+    return history
+
+
 def load_history_from_sheets(service, stock_id=None):
     if not service:
         return []
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H"
-        ).execute()
-        values = result.get("values", [])
-        history = []
-        for row in values:
-            if len(row) >= 4 and (stock_id is None or row[0] == stock_id):
-                try:
-                    price = float(row[3]) if row[3] else None
-                except:
-                    price = None
-                history.append({
-                    "date": row[2],
-                    "price": price,
-                    "ma5": row[4] if len(row) > 4 else None,
-                    "ma20": row[5] if len(row) > 5 else None,
-                    "ma60": row[6] if len(row) > 6 else None,
-                    "timestamp": row[7] if len(row) > 7 else row[2]
-                })
-        return history
+        if stock_id and is_per_stock():
+            # 分頁配置：只下載該股票自己的分頁
+            result = service.spreadsheets().values().get(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                range=history_range(stock_id)
+            ).execute()
+            return rows_to_history(result.get("values", []), stock_id)
+        return rows_to_history(load_sheet_rows(service), stock_id)
     except Exception as e:
         write_log(f"讀取 Sheets 失敗：{e}")
         return []
 
-def update_row_in_sheets(service, stock_id, date, stock_name, price, ma5, ma20, ma60, timestamp):
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H"
-        ).execute()
-        values = result.get("values", [])
-        for idx, row in enumerate(values):
-            if len(row) > 2 and row[0] == stock_id and row[2] == date:
-                update_range = f"{SHEET_NAME}!A{idx+2}:H{idx+2}"
-                update_values = [[stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp]]
-                service.spreadsheets().values().update(
-                    spreadsheetId=GOOGLE_SHEET_ID,
-                    range=update_range,
-                    valueInputOption="RAW",
-                    body={"values": update_values}
-                ).execute()
-                write_log(f"{stock_id} 覆蓋 Sheets 成功：{date} - {price if price else 'None'}")
-                return True
-        # 沒找到就新增
-        values = [[stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp]]
-        service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2",
-            valueInputOption="RAW",
-            body={"values": values}
-        ).execute()
-        write_log(f"{stock_id} 新增 Sheets 成功：{date} - {price if price else 'None'}")
-        return True
-    except Exception as e:
-        write_log(f"{stock_id} 更新/新增 Sheets 失敗：{e}")
-        return False
-
-def calculate_ma(prices, window):
-    if len(prices) < window:
-        return None
-    return pd.Series(prices).rolling(window).mean().iloc[-1]
 
-def trim_history_to_limit(service, stock_id, limit=500):
-    if not service:
-        return
+def build_row_index(values):
+    """建立 (股票代號, 日期) → 試算表列號 的對照表；列號從 2 起算（第 1 列為標題），分頁由 history_tab 決定。"""
+    row_index = {}
+    for idx, row in enumerate(values):
+        if len(row) > 2:
+            row_index.setdefault((row[0], row[2]), idx + 2)
+    return row_index
+
+
+def _first_row_of_range(a1_range):
+    """從 'Sheet1!A120:H131' 取出起始列號 120，解析失敗回傳 None。"""
+    match = re.search(r"![A-Z]+(\d+)", a1_range or "")
+    return int(match.group(1)) if match else None
+
+
+def sheets_execute(request):
+    """送出 Sheets 寫入請求：先取得限流 token，遇到 429 依限流器退避後重試。"""
+    return call_with_backoff(SHEETS_RATE_LIMITER, request.execute, log=write_log)
+
+
+def batch_upsert_rows(service, row_index, rows, sheet_ids=None):
+    """
+    一次寫入所有待更新資料：
+    - 已存在的 (股票, 日期) → 合併成一次 values.batchUpdate 覆蓋
+    - 不存在的 → 合併成一次 append 新增，並把新列號補回 row_index；
+      per_stock 配置則以一次 batchUpdate（appendCells）附加到各股分頁，需傳入 sheet_ids
+    回傳 (覆蓋筆數, 新增筆數)，失敗時只計入已成功送出的部分
+    """
+    updates = []
+    appends = []
+    for row in rows:
+        row_no = row_index.get((row[0], row[2]))
+        if row_no:
+            updates.append({"range": f"{history_tab(row[0])}!A{row_no}:H{row_no}", "values": [row]})
+        else:
+            appends.append(row)
+
+    updated = appended = 0
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H"
-        ).execute()
-        values = result.get("values", [])
-        stock_rows = [row for row in values if len(row) > 0 and row[0] == stock_id]
-        if len(stock_rows) <= limit:
-            return
-        # 保留最新的 limit 筆
-        keep_rows = stock_rows[-limit:]
-        keep_dates = {row[2] for row in keep_rows}
-        new_values = [row for row in values if len(row) == 0 or row[0] != stock_id or row[2] in keep_dates]
-        service.spreadsheets().values().clear(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H",
-            body={}
-        ).execute()
-        if new_values:
-            service.spreadsheets().values().update(
+        if updates:
+            sheets_execute(service.spreadsheets().values().batchUpdate(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                body={"valueInputOption": "RAW", "data": updates}
+            ))
+            updated = len(updates)
+        if appends and is_per_stock():
+            rows_by_tab = {}
+            for row in appends:
+                rows_by_tab.setdefault(history_tab(row[0]), []).append(to_row_data(row))
+            sheets_execute(service.spreadsheets().batchUpdate(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                body={"requests": [{"appendCells": {
+                    "sheetId": sheet_ids[tab],
+                    "rows": tab_rows,
+                    "fields": "userEnteredValue"
+                }} for tab, tab_rows in rows_by_tab.items()]}
+            ))
+            appended = len(appends)
+        elif appends:
+            result = sheets_execute(service.spreadsheets().values().append(
                 spreadsheetId=GOOGLE_SHEET_ID,
                 range=f"{SHEET_NAME}!A2",
                 valueInputOption="RAW",
-                body={"values": new_values}
-            ).execute()
-        write_log(f"{stock_id} 清理完成，保留最新 {len(keep_rows)} 筆")
+                body={"values": appends}
+            ))
+            appended = len(appends)
+            first_row = _first_row_of_range(result.get("updates", {}).get("updatedRange"))
+            if first_row:
+                for offset, row in enumerate(appends):
+                    row_index.setdefault((row[0], row[2]), first_row + offset)
+        write_log(f"批次寫入 Sheets 完成：覆蓋 {updated} 筆、新增 {appended} 筆")
     except Exception as e:
-        write_log(f"{stock_id} 清理歷史資料失敗：{e}")
+        SHEET_STATE.forget()
+        write_log(f"批次寫入 Sheets 失敗（已完成覆蓋 {updated} 筆）：{e}")
+    return updated, appended
+
+def compute_trim_ranges(values, limit):
+    """
+    每支股票依日期保留最新 limit 筆，其餘列合併成連續區間。
+    回傳 [(startIndex, endIndex)]，為 deleteDimension 使用的 0 起算列索引（endIndex 不含）。
+    """
+    rows_by_stock = {}
+    for idx, row in enumerate(values):
+        if len(row) > 2 and row[0]:
+            rows_by_stock.setdefault(row[0], []).append((row[2], idx))
+
+    drop = []
+    for items in rows_by_stock.values():
+        if len(items) > limit:
+            items.sort()
+            drop.extend(idx for _, idx in items[:-limit])
+    drop.sort()
+
+    ranges = []
+    for idx in drop:
+        row_index = idx + 1  # values 從第 2 列（索引 1）開始
+        if ranges and ranges[-1][1] == row_index:
+            ranges[-1][1] = row_index + 1
+        else:
+            ranges.append([row_index, row_index + 1])
+    return [tuple(r) for r in ranges]
+
+
+def trim_history_to_limit(service, limit=500, tabs=None):
+    """
+    一次清理所有股票超過 limit 筆的舊資料：算出要刪的連續列區間，
+    由下往上組成 deleteDimension 請求，以單一 batchUpdate 原子性送出（不會出現清空後重寫的空窗）。
+    tabs 為 {分頁名稱: values}，未傳入時依配置讀取 Sheet1 或所有股票分頁。
+    """
+    if not service:
+        return 0
+    try:
+        sheet_ids = SHEET_STATE.sheet_ids(service)
+        if tabs is None:
+            if is_per_stock():
+                stock_ids = [t[len(STOCK_TAB_PREFIX):] for t in sheet_ids if t.startswith(STOCK_TAB_PREFIX)]
+                tabs = load_history_tabs(service, stock_ids) if stock_ids else {}
+            else:
+                tabs = {SHEET_NAME: load_sheet_rows(service)}
+        requests = []
+        removed = 0
+        for tab, values in tabs.items():
+            sheet_id = sheet_ids.get(tab)
+            if sheet_id is None:
+                write_log(f"⚠️ 無法取得 {tab} ID，跳過清理")
+                continue
+            ranges = compute_trim_ranges(values, limit)
+            removed += sum(end - start for start, end in ranges)
+            requests.extend({"deleteDimension": {"range": {
+                "sheetId": sheet_id,
+                "dimension": "ROWS",
+                "startIndex": start,
+                "endIndex": end
+            }}} for start, end in reversed(ranges))
+        if not requests:
+            write_log(f"所有股票皆未超過 {limit} 筆，不需清理")
+            return 0
+        sheets_execute(service.spreadsheets().batchUpdate(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            body={"requests": requests}
+        ))
+        write_log(f"清理完成：刪除 {removed} 筆（{len(requests)} 個區間），每支股票保留最新 {limit} 筆")
+        return removed
+    except Exception as e:
+        SHEET_STATE.forget()
+        write_log(f"清理歷史資料失敗：{e}")
+        return 0
 
 # ======================== 主補齊函式 ========================
-def fill_missing_history(service, dl, stock_list, stock_name_map):
-    tz = timezone(timedelta(hours=8))
-    now = datetime.now(tz)
-    end_date = now.strftime("%Y-%m-%d")
+def iter_date_chunks(start_date, end_date, days=None):
+    """把 start_date～end_date（含頭尾）切成每段最多 days 天，依序產生 (段起日, 段迄日)。"""
+    days = days or CHUNK_DAYS
+    current = datetime.strptime(start_date, "%Y-%m-%d")
+    last = datetime.strptime(end_date, "%Y-%m-%d")
+    while current <= last:
+        chunk_end = min(current + timedelta(days=days - 1), last)
+        yield current.strftime("%Y-%m-%d"), chunk_end.strftime("%Y-%m-%d")
+        current = chunk_end + timedelta(days=1)
+
+
+def _is_complete(row):
+    """已有收盤價、MA5、MA20 的資料列不需要重寫。"""
+    h = rows_to_history([row])
+    if not h:
+        return False
+    h = h[0]
+    return all([
+        h.get("price") not in (None, '', 'None'),
+        h.get("ma5") not in (None, '', '無資料'),
+        h.get("ma20") not in (None, '', '無資料'),
+    ])
+
+
+def load_row_index(service, stock_list):
+    """
+    讀取既有資料一次，只留下列號索引、已完整的 (股票, 日期) 集合與各分頁最後一列，
+    資料內容本身不留在記憶體。
+    """
+    row_index = {}
+    complete = set()
+    tab_rows = {}
+    for tab, values in load_history_tabs(service, stock_list).items():
+        row_index.update(build_row_index(values))
+        tab_rows[tab] = len(values) + 1
+        complete.update((row[0], row[2]) for row in values if len(row) >= 4 and _is_complete(row))
+    return row_index, complete, tab_rows
+
+
+def peak_rss_mib():
+    """本行程到目前為止的峰值記憶體（MiB）；不支援的平台回傳 None。"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
 
-    for stock_id in stock_list:
-        stock_name = stock_name_map.get(stock_id, stock_id)
-        write_log(f"開始處理 {stock_id} ({stock_name})")
 
-        # 讀取目前歷史（只用來比對）
-        history = load_history_from_sheets(service, stock_id)
-        history_map = {h["date"]: h for h in history}
+def today_date():
+    """台灣時間的今天；當天日K要收盤後才會公布。"""
+    return datetime.now(timezone(timedelta(hours=8))).strftime("%Y-%m-%d")
 
-        # 只下載最近 BATCH_DAYS 天
-        start_date = (now - timedelta(days=BATCH_DAYS)).strftime("%Y-%m-%d")
-        write_log(f"{stock_id} 下載範圍：{start_date} ~ {end_date}")
 
-        try:
-            df = dl.taiwan_stock_daily(stock_id, start_date=start_date, end_date=end_date)
-        except Exception as e:
-            write_log(f"{stock_id} FinMind 取得歷史資料失敗：{e}，跳過")
-            continue
+def pending_bar_date():
+    """
+    今天的日K可能還沒公布時回傳今天，否則回傳 None：依本機交易日曆（推播程式每天更新），
+    週末與日曆已知的休市日不會有當天日K，不必等；日曆無法判斷時視為交易日。
+    """
+    today = today_date()
+    return today if TradingCalendar().lookup(today) is not False else None
 
-        if df.empty:
-            write_log(f"{stock_id} 最近 {BATCH_DAYS} 天無資料，跳過")
-            continue
 
-        dates = df["date"].tolist()
-        closes = df["close"].tolist()
+def resolve_date_range(start_date=None, end_date=None):
+    """補齊區間預設為最近 BATCH_DAYS 天（台灣時間）。"""
+    today = today_date()
+    end_date = end_date or today
+    start_date = start_date or (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=BATCH_DAYS)).strftime("%Y-%m-%d")
+    return start_date, end_date
 
-        updated = 0
-        for i, date in enumerate(dates):
-            price = closes[i]
 
-            ma5  = calculate_ma(closes[:i+1], 5)   if i+1 >= 5  else None
-            ma20 = calculate_ma(closes[:i+1], 20)  if i+1 >= 20 else None
-            ma60 = calculate_ma(closes[:i+1], 60)  if i+1 >= 60 else None
+def warmup_date(date):
+    """往前多抓一段暖機資料，區間第一天就有完整的 MA60。"""
+    return (datetime.strptime(date, "%Y-%m-%d") - timedelta(days=MA_WARMUP_DAYS)).strftime("%Y-%m-%d")
 
-            timestamp = f"{date} 00:00:00"
 
-            exist = history_map.get(date)
-            need_update = True
+def plan_backfill(checkpoint, stock_list, start_date, end_date):
+    """依檢查點列出尚未完成的股票：[(股票, 本次起日, 需要的 FinMind 請求數)]。"""
+    plan = []
+    for stock_id in stock_list:
+        resume_from = checkpoint.resume_date(stock_id, start_date)
+        if resume_from is None or resume_from > end_date:
+            continue
+        plan.append((stock_id, resume_from, sum(1 for _ in iter_date_chunks(warmup_date(resume_from), end_date))))
+    return plan
+
+
+def report_pending_backfill(stock_list, start_date=None, end_date=None):
+    """--dry-run：只讀本機檢查點，列出待補的股票、起日與預估請求數，不讀寫 Sheets 歷史資料、不呼叫 FinMind。"""
+    start_date, end_date = resolve_date_range(start_date, end_date)
+    checkpoint = BackfillCheckpoint(start_date, end_date, open_date=pending_bar_date())
+    plan = plan_backfill(checkpoint, stock_list, start_date, end_date)
+    done = [s for s in stock_list if checkpoint.is_done(s)]
+    write_log(f"補齊範圍：{start_date} ~ {end_date}，"
+              f"{'沿用檢查點' if checkpoint.resumed else '尚無檢查點（全新工作）'}")
+    if checkpoint.last:
+        write_log(f"上次寫入到 {checkpoint.last['stock_id']} {checkpoint.last['date']}，"
+                  f"已用 FinMind 請求 {checkpoint.requests_used} 次")
+    if done:
+        write_log(f"已完成 {len(done)} 支，將跳過：{done}")
+    for stock_id, resume_from, requests in plan:
+        status = "續補" if checkpoint.committed_through(stock_id) else "新補"
+        write_log(f"{stock_id} {status}：{resume_from} ~ {end_date}，預估 {requests} 次請求")
+    total = sum(requests for _, _, requests in plan)
+    budget = f"，本次上限 {BACKFILL_REQUEST_BUDGET} 次" if BACKFILL_REQUEST_BUDGET > 0 else ""
+    rate = FINMIND_RATE_LIMITER.max_rate
+    estimate = f"，以每秒 {rate:g} 次至少約 {total / rate:.0f} 秒" if rate > 0 else ""
+    write_log(f"待補 {len(plan)} 支、預估 {total} 次 FinMind 請求{estimate}{budget}")
+    return plan
+
+
+def backfill_stock(dl, stock_id, stock_name, resume_from, end_date, complete, out, take_request, stop):
+    """
+    worker：依 CHUNK_DAYS 分段下載單一股票，每段算好的資料列以 ("rows", 股票, 段迄日, 資料列) 交給主執行緒寫入；
+    結束時送出 ("done", 股票, 筆數, 狀態)，狀態為 finished／failed／budget／stopped。
+    段與段之間只帶著 MA60 需要的最後 60 筆收盤（MATracker）。
+    """
+    tracker = MATracker()
+    pending = 0
+    status = None
+    try:
+        for chunk_start, chunk_end in iter_date_chunks(warmup_date(resume_from), end_date):
+            if stop.is_set():
+                status = "stopped"
+                break
+            if not take_request():
+                status = "budget"
+                break
+            try:
+                df = call_with_backoff(FINMIND_RATE_LIMITER, dl.taiwan_stock_daily, stock_id,
+                                       start_date=chunk_start, end_date=chunk_end, log=write_log)
+            except Exception as e:
+                write_log(f"{stock_id} FinMind 取得 {chunk_start} ~ {chunk_end} 失敗：{e}，跳過此股票其餘區間")
+                status = "failed"
+                break
+            rows = []
+            if df is not None and not df.empty:
+                for date, price in zip(df["date"].tolist(), df["close"].tolist()):
+                    mas = tracker.push(stock_id, price)
+                    if date < resume_from or (stock_id, date) in complete:
+                        continue
+                    rows.append([stock_id, stock_name, date, price,
+                                 ma_or_none(mas[5]), ma_or_none(mas[20]), ma_or_none(mas[60]),
+                                 f"{date} 00:00:00"])
+            del df
+            pending += len(rows)
+            out.put(("rows", stock_id, chunk_end, rows))
+        status = status or "finished"
+    except Exception as e:
+        write_log(f"{stock_id} 補齊異常：{e}")
+    finally:
+        out.put(("done", stock_id, pending, status or "failed"))
+
+
+def fill_missing_history(service, dl, stock_list, stock_name_map, start_date=None, end_date=None):
+    """
+    串流補齊 start_date～end_date（預設最近 BATCH_DAYS 天）的收盤價與均線：
+    BACKFILL_WORKERS 個 worker 同時下載不同股票（共用 FinMind 限流器，遇到 rate limit 自動退避），
+    主執行緒負責所有 Sheets 寫入與檢查點：待寫入資料累積到 WRITE_BATCH_ROWS 筆就寫出，
+    worker 與主執行緒之間的佇列有上限，記憶體用量與補齊區間長短無關。
+    每次確定寫入後更新本機檢查點；同一區間重新執行時從上次寫到的日期繼續，已完成的股票直接跳過。
+    """
+    start_date, end_date = resolve_date_range(start_date, end_date)
+    checkpoint = BackfillCheckpoint(start_date, end_date, open_date=pending_bar_date())
+    plan = plan_backfill(checkpoint, stock_list, start_date, end_date)
+    if checkpoint.resumed:
+        skipped = len(stock_list) - len(plan)
+        last = checkpoint.last
+        write_log(f"從檢查點繼續：略過已完成 {skipped} 支"
+                  + (f"，上次寫到 {last['stock_id']} {last['date']}" if last else ""))
+    if not plan:
+        write_log("所有股票都已補齊，無需處理")
+        return
 
-            if exist:
-                if all([
-                    exist.get("price") not in (None, '', 'None'),
-                    exist.get("ma5")  not in (None, '', '無資料'),
-                    exist.get("ma20") not in (None, '', '無資料'),
-                ]):
-                    need_update = False
+    # 整次執行只讀一次 Sheets（分頁配置下只讀清單內股票的分頁），只保留列號索引
+    try:
+        sheet_ids = ensure_stock_tabs(service, SHEET_STATE, [s for s, _, _ in plan], log=write_log)
+        row_index, complete, tab_rows = load_row_index(service, [s for s, _, _ in plan])
+    except Exception as e:
+        write_log(f"讀取 Sheets 失敗：{e}，結束補齊")
+        return
 
-            if need_update:
-                success = update_row_in_sheets(
-                    service, stock_id, date, stock_name, price, ma5, ma20, ma60, timestamp
-                )
-                if success:
-                    updated += 1
+    totals = {"updated": 0, "appended": 0}
+    pending_rows = []
+    progress = {}   # 已處理（含尚未寫出）到的日期，寫入成功後才記入檢查點
+    finished = []
+
+    def flush_pending():
+        """寫出待寫入資料；全部成功才推進檢查點，回傳是否成功。"""
+        if pending_rows:
+            for row in pending_rows:
+                if (row[0], row[2]) not in row_index:
+                    tab = history_tab(row[0])
+                    tab_rows[tab] = tab_rows.get(tab, 1) + 1
+            updated, appended = batch_upsert_rows(service, row_index, pending_rows, sheet_ids)
+            totals["updated"] += updated
+            totals["appended"] += appended
+            written = updated + appended == len(pending_rows)
+            pending_rows.clear()
+            if not written:
+                return False
+        checkpoint.commit(progress, finished)
+        progress.clear()
+        finished.clear()
+        return True
 
-            # 每寫幾筆休息一下
-            if (i + 1) % SLEEP_BETWEEN_WRITES == 0:
-                time.sleep(5)
+    budget_lock = threading.Lock()
+    requests_sent = [0]
+
+    def take_request():
+        """所有 worker 共用的本次請求額度（BACKFILL_REQUEST_BUDGET），同時累計到檢查點。"""
+        with budget_lock:
+            if BACKFILL_REQUEST_BUDGET > 0 and requests_sent[0] >= BACKFILL_REQUEST_BUDGET:
+                return False
+            requests_sent[0] += 1
+            checkpoint.requests_used += 1
+            return True
+
+    workers = max(1, min(BACKFILL_WORKERS, len(plan)))
+    out = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    stopped = False
+    write_log(f"補齊範圍：{start_date} ~ {end_date}，{len(plan)} 支股票、{workers} 個 worker")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for stock_id, resume_from, _ in plan:
+            stock_name = stock_name_map.get(stock_id, stock_id)
+            write_log(f"排入 {stock_id} ({stock_name})，補齊範圍：{resume_from} ~ {end_date}")
+            pool.submit(backfill_stock, dl, stock_id, stock_name, resume_from, end_date,
+                        complete, out, take_request, stop)
+
+        remaining = len(plan)
+        try:
+            while remaining:
+                message = out.get()
+                if message[0] == "rows":
+                    _, stock_id, chunk_end, rows = message
+                    if stop.is_set():
+                        continue  # 已中斷：丟棄尚未寫出的資料，下次從檢查點重抓
+                    pending_rows.extend(rows)
+                    # 今天的日K尚未公布時，進度只記到昨天，同一天重新執行會再抓今天
+                    open_date = checkpoint.open_date
+                    has_open_bar = bool(open_date) and ((stock_id, open_date) in complete
+                                                        or any(row[2] == open_date for row in rows))
+                    progress[stock_id] = checkpoint.settled_date(chunk_end, has_open_bar)
+                    # 累積到上限就先寫出；最近 90 天的日常補齊仍是整批一次寫入
+                    if len(pending_rows) >= WRITE_BATCH_ROWS and not flush_pending():
+                        stop.set()
+                    continue
+
+                _, stock_id, pending, status = message
+                remaining -= 1
+                write_log(f"{stock_id} 待更新/補齊 {pending} 筆")
+                if status == "budget":
+                    write_log(f"已達本次請求上限 {BACKFILL_REQUEST_BUDGET} 次，{stock_id} 下次從檢查點繼續")
+                if status != "finished" or stop.is_set():
+                    stopped = stopped or status in ("budget", "stopped")
+                    continue
+                finished.append(stock_id)
+                # 沒有待寫入資料時檢查點可以直接推進
+                if not pending_rows:
+                    flush_pending()
+        except BaseException:
+            # 主執行緒中斷（例如 Ctrl+C）：通知 worker 停止並清空佇列，避免 worker 卡在 put 無法結束
+            stop.set()
+            while remaining:
+                if out.get()[0] == "done":
+                    remaining -= 1
+            raise
+
+    if stop.is_set() or not flush_pending():
+        stopped = True
+    if stopped:
+        write_log("補齊中斷，已寫入的進度保留在檢查點，下次執行從中斷處繼續")
+    for tab, last_row in tab_rows.items():
+        SHEET_STATE.note_rows(tab, last_row)
+    if totals["updated"] or totals["appended"]:
+        write_log(f"本次完成：覆蓋 {totals['updated']} 筆、新增 {totals['appended']} 筆")
+    else:
+        write_log("本次無需更新任何資料")
+    write_log(f"本次 FinMind 請求 {requests_sent[0]} 次（此區間累計 {checkpoint.requests_used} 次）")
+    peak = peak_rss_mib()
+    if peak is not None:
+        write_log(f"峰值記憶體：{peak:.1f} MiB")
+
+    # 保留筆數上限（HISTORY_LIMIT > 0 才啟用），所有股票一次清理
+    if HISTORY_LIMIT > 0:
+        trim_history_to_limit(service, limit=HISTORY_LIMIT)
+
+# ======================== 配置轉換 ========================
+def migrate_to_per_stock_layout(service):
+    """
+    把 Sheet1 的單一分頁配置轉成每支股票一個分頁：讀取 Sheet1 一次，依股票分組、按日期排序，
+    以單一 batchUpdate 建立所有分頁並寫入資料與格式（要嘛全部成功、要嘛全部不生效）。
+    已有分頁的股票略過；Sheet1 原資料保留（推播計數仍在 J1:K1），確認無誤後可自行刪除。
+    """
+    result = service.spreadsheets().values().get(
+        spreadsheetId=GOOGLE_SHEET_ID,
+        range=f"{SHEET_NAME}!A1:H",
+        valueRenderOption="UNFORMATTED_VALUE"
+    ).execute()
+    values = result.get("values", [])
+    header, rows = (values[0], values[1:]) if values else (None, [])
+
+    stock_rows = {}
+    for row in rows:
+        if len(row) > 2 and str(row[0]).strip():
+            row = list(row) + [""] * (8 - len(row))
+            row[0] = str(row[0]).strip()
+            stock_rows.setdefault(row[0], []).append(row[:8])
+
+    existing = SHEET_STATE.sheet_ids(service, refresh=True)
+    skipped = [s for s in stock_rows if stock_tab(s) in existing]
+    for stock_id in skipped:
+        del stock_rows[stock_id]
+    if skipped:
+        write_log(f"已有分頁，略過轉換：{skipped}")
+    if not stock_rows:
+        write_log("沒有需要轉換的股票")
+        return 0
+
+    for items in stock_rows.values():
+        items.sort(key=lambda row: str(row[2]))
+    created = create_stock_tabs(service, SHEET_STATE, stock_rows, header)
+    total = sum(len(items) for items in stock_rows.values())
+    write_log(f"✅ 配置轉換完成：建立 {len(created)} 個分頁、搬移 {total} 筆；"
+              f"請設定 SHEET_LAYOUT=per_stock 啟用分頁配置")
+    return total
 
-        write_log(f"{stock_id} 本次完成：更新/補齊 {updated} 筆（最近 {BATCH_DAYS} 天）")
+# ======================== 主程式 ========================
+def _date_arg(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式應為 YYYY-MM-DD：{value}")
 
-        # 強制釋放記憶體
-        del df, dates, closes
-        gc.collect()
 
-        # 每支股票處理完休息
-        time.sleep(SLEEP_BETWEEN_STOCKS)
+def parse_args():
+    parser = argparse.ArgumentParser(description="補齊歷史收盤價與均線")
+    parser.add_argument("--start", type=_date_arg, help=f"補齊起日（預設為 {BATCH_DAYS} 天前），可回補多年資料")
+    parser.add_argument("--end", type=_date_arg, help="補齊迄日（預設為今天）")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="只列出待補的股票與預估請求數（依本機檢查點），不寫入 Sheets、不呼叫 FinMind")
+    parser.add_argument("--migrate-layout", action="store_true",
+                        help="把 Sheet1 轉成每支股票一個分頁（一次 batchUpdate），完成後結束")
+    return parser.parse_args()
 
-        # 可選：清理舊資料（建議先註解，等資料補齊再開啟）
-        # trim_history_to_limit(service, stock_id, limit=500)
 
-# ======================== 主程式 ========================
 def main():
+    args = parse_args()
     write_log("=== 開始補齊歷史收盤價與均線 ===")
     service = get_sheets_service()
     if not service:
         write_log("無法連線 Google Sheets，結束執行")
         return
 
-    dl = DataLoader()
-    dl.login_by_token(FINMIND_TOKEN)
+    if args.migrate_layout:
+        try:
+            migrate_to_per_stock_layout(service)
+        except Exception as e:
+            write_log(f"配置轉換失敗：{e}")
+        return
 
     sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(service)
     active_stock_list = sheets_stock_list if sheets_stock_list else STOCK_LIST
     active_stock_name_map = sheets_stock_name_map if sheets_stock_name_map else STOCK_NAME_MAP
 
-    fill_missing_history(service, dl, active_stock_list, active_stock_name_map)
-    apply_sheet_formatting(service)
+    if args.dry_run:
+        report_pending_backfill(active_stock_list, start_date=args.start, end_date=args.end)
+        return
+
+    dl = Traced(DataLoader(), TRACER, "finmind")
+    dl.login_by_token(FINMIND_TOKEN)
+
+    fill_missing_history(service, dl, active_stock_list, active_stock_name_map,
+                         start_date=args.start, end_date=args.end)
+    apply_sheet_formatting(service, active_stock_list)
     reset_sheet_filter(service)
 
     write_log("=== 補齊流程結束 ===")
 
+
+def write_run_summary():
+    try:
+        TRACER.write_summary()
+        write_log(TRACER.footer())
+    except Exception as e:
+        write_log(f"寫入執行效能紀錄失敗：{e}")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 同一台機器上已有補齊在執行（例如前一次回補多年資料尚未結束）時直接略過，避免重複寫入
+    lock = RunLock("stock-history-fill")
+    ledger = RunLedger("stock-history-fill")
+    ledger.start()
+    if not lock.acquire():
+        holder = lock.holder() or {}
+        write_log(f"已有補齊程式在執行（pid {holder.get('pid')}，{holder.get('started_at')} 開始），略過本次")
+        ledger.record("skipped", TRACER.run_id, holder=holder)
+        sys.exit(0)
+    status = "error"
+    try:
+        main()
+        status = "ok"
+    finally:
+        lock.release()
+        ledger.record(status, TRACER.run_id)
+        write_run_summary()
\ No newline at end of file
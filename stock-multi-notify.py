@@ -1,23 +1,41 @@
+import argparse
 import os
 import re
+import signal
 import sys
+import threading
 from dotenv import load_dotenv
 load_dotenv()
 
 sys.stdout.reconfigure(encoding='utf-8')
 
-import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional
 
-import pandas as pd
-from FinMind.data import DataLoader
-import requests
-import yfinance as yf
 import time
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+# pandas、FinMind、yfinance、googleapiclient 載入需 1～2 秒，改在第一次使用時才 import，
+# 盤前、週末與日曆已知的休市日可在建立任何連線前直接結束
+
+from moving_average import MATracker
+from price_providers import (FinMindDailyProvider, FinMindSnapshot, FinMindTickProvider, HedgedResolver,
+                             LatencyStats, YFinanceProvider)
+from price_store import PriceStore
+from push_state import PushState
+from buffered_log import create_logger
+from discord_notifier import DiscordNotifier
+from finmind_cache import CachedDataLoader
+from local_cache import cache_path, load_json, save_json
+from rate_limit import RateLimited, RateLimiter
+from sheet_layout import (MAIN_SHEET, SheetState, append_history_rows, apply_formatting, ensure_stock_tabs,
+                          history_tab, is_per_stock)
+from run_guard import RunLedger, RunLock
+from run_metrics import RunTracer, Traced, payload_size, traced_request_builder
+from sheets_client import build_sheets_service
+from stock_scheduler import Deadline, StockScheduler
+from symbol_index import SymbolIndex
+from trading_calendar import TradingCalendar
 
 # ======================== 環境變數 ========================
 GOOGLE_SHEETS_CREDENTIALS = os.getenv("GOOGLE_SHEETS_CREDENTIALS")
@@ -30,7 +48,7 @@ if not all([GOOGLE_SHEETS_CREDENTIALS, GOOGLE_SHEET_ID, FINMIND_TOKEN]):
 
 # ======================== 參數設定 ========================
 STOCK_LIST = ["2330", "6770", "3481", "2337", "2344", "2409", "2367", "3374", "3324", "00642U", "0050", "2231"]
-SHEET_NAME = "Sheet1"
+SHEET_NAME = MAIN_SHEET
 CONFIG_SHEET_NAME = "Config"  # Google Sheets 股票清單分頁名稱
 
 STOCK_NAME_MAP = {
@@ -48,16 +66,52 @@ STOCK_NAME_MAP = {
     "2231": "為升"
 }
 
+# 本次執行的對外呼叫紀錄（耗時、資料量、重試、快取命中），結束時寫入 run_metrics.jsonl
+TRACER = RunTracer("stock-multi-notify")
+
+# 分頁 sheetId 與格式套用紀錄（本機快取），盤中每 5 分鐘執行時不必重複查 ID、重套格式
+SHEET_STATE = SheetState(GOOGLE_SHEET_ID)
+
+# 並行抓取設定：同時處理的股票數與各資料來源每秒請求上限
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+FINMIND_RATE_LIMITER = RateLimiter(float(os.getenv("FINMIND_REQUESTS_PER_SEC", "5")), burst=FETCH_CONCURRENCY)
+YFINANCE_RATE_LIMITER = RateLimiter(float(os.getenv("YFINANCE_REQUESTS_PER_SEC", "1")))
+
+# 取價來源 hedge：目前來源超過延遲仍未回應就同時問下一個來源；延遲依實際回應時間自動調整
+PRICE_LATENCY = LatencyStats(float(os.getenv("HEDGE_DELAY_SECONDS", "1.5")))
+PRICE_RESOLVER = HedgedResolver(PRICE_LATENCY, max_workers=max(1, FETCH_CONCURRENCY) * 3,
+                                log=lambda msg: write_log(msg))
+
+# 取價模式：snapshot 以一次請求取得整份清單的最新價（缺的才逐支查），per_stock 每支股票各自查詢
+QUOTE_MODE = os.getenv("QUOTE_MODE", "snapshot").lower()
+PRICE_SNAPSHOT = FinMindSnapshot(log=lambda msg: write_log(msg))
+
+# 常駐模式（--daemon）排程：盤中間隔、盤後執行時間點、Config 重讀間隔
+DAEMON_INTERVAL_MINUTES = int(os.getenv("DAEMON_INTERVAL_MINUTES", "5"))
+DAEMON_POST_CLOSE_TIMES = os.getenv("DAEMON_POST_CLOSE_TIMES", "14:05,15:00")
+CONFIG_REFRESH_MINUTES = float(os.getenv("CONFIG_REFRESH_MINUTES", "15"))
+DAEMON_STOP = threading.Event()
+
+# 大量股票：盤中分組輪流處理、每個週期的期限（預設比排程間隔少 1 分鐘，避免與下一次重疊）
+STOCK_SHARDS = int(os.getenv("STOCK_SHARDS", "1"))
+CYCLE_DEADLINE_SECONDS = float(os.getenv("CYCLE_DEADLINE_SECONDS", str(max(60, DAEMON_INTERVAL_MINUTES * 60 - 60))))
+FETCH_DEADLINE_RATIO = 0.8  # 抓取階段最多用到期限的 80%，其餘留給推播與寫入
+STOCK_SCHEDULER = StockScheduler(STOCK_SHARDS)
+
+# 避免重複執行：前一次還在跑時，新的一次最多等 RUN_LOCK_WAIT_SECONDS 秒（0 表示直接略過）
+RUN_LOCK_WAIT_SECONDS = float(os.getenv("RUN_LOCK_WAIT_SECONDS", "0"))
+RUN_LEDGER = RunLedger("stock-multi-notify")
+PUSH_COUNTER_PATH = cache_path("push_counter.json")  # 本機推播計數，Sheets J1:K1 只負責同步
+
+# 盤中變動偵測：價格相對上次推播變動未超過 PUSH_CHANGE_PCT（%）且建議相同的股票只列入「未變動」摘要
+PUSH_STATE = PushState(float(os.getenv("PUSH_CHANGE_PCT", "0.5")))
+
 # ==========================================================
 def get_sheets_service():
+    """內建 discovery 文件 + 本機快取的 token：token 仍有效時建立連線不需任何網路往返。"""
     try:
-        creds_json = GOOGLE_SHEETS_CREDENTIALS
-        credentials_info = json.loads(creds_json)
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_info,
-            scopes=["https://www.googleapis.com/auth/spreadsheets"]
-        )
-        service = build("sheets", "v4", credentials=credentials)
+        service, _, _ = build_sheets_service(GOOGLE_SHEETS_CREDENTIALS, traced_request_builder(TRACER),
+                                             log=write_log)
         write_log("✅ Google Sheets 連線成功")
         return service
     except Exception as e:
@@ -66,55 +120,28 @@ def get_sheets_service():
 
 
 def get_sheet_id(service, sheet_name):
+    """sheetId 先查本機快取（SHEET_STATE），沒有才呼叫 spreadsheets().get。"""
     try:
-        spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
-        for sheet in spreadsheet["sheets"]:
-            if sheet["properties"]["title"] == sheet_name:
-                return sheet["properties"]["sheetId"]
+        return SHEET_STATE.sheet_id(service, sheet_name)
     except Exception as e:
         write_log(f"取得 sheet ID 失敗：{e}")
     return None
 
 
-def apply_sheet_formatting(service):
-    """套用 Sheet1 欄位格式：文字靠左（A、B、C、H）、數字靠右（D、E、F、G）"""
-    sheet_id = get_sheet_id(service, SHEET_NAME)
-    if sheet_id is None:
-        write_log("⚠️ 無法取得 Sheet1 ID，跳過格式套用")
-        return
+def apply_sheet_formatting(service, stock_ids):
+    """
+    套用歷史資料欄位格式：文字靠左（A、B、C、H）、數字靠右（D、E、F、G）。
+    只在格式版本改變或資料超出已格式化範圍時才送出，否則不呼叫任何 API。
+    """
+    titles = list(dict.fromkeys(history_tab(s) for s in stock_ids))
     try:
-        requests = []
-        # A欄（股票代號）→ 純文字格式，防止 0050 被吃成 50
-        requests.append({"repeatCell": {
-            "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 10000,
-                      "startColumnIndex": 0, "endColumnIndex": 1},
-            "cell": {"userEnteredFormat": {
-                "horizontalAlignment": "LEFT",
-                "numberFormat": {"type": "TEXT"}
-            }},
-            "fields": "userEnteredFormat.horizontalAlignment,userEnteredFormat.numberFormat"
-        }})
-        for col in [1, 2, 7]:  # B=名稱, C=日期, H=timestamp → 靠左
-            requests.append({"repeatCell": {
-                "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 10000,
-                          "startColumnIndex": col, "endColumnIndex": col + 1},
-                "cell": {"userEnteredFormat": {"horizontalAlignment": "LEFT"}},
-                "fields": "userEnteredFormat.horizontalAlignment"
-            }})
-        for col in [3, 4, 5, 6]:  # D=收盤價, E=MA5, F=MA20, G=MA60 → 靠右
-            requests.append({"repeatCell": {
-                "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 10000,
-                          "startColumnIndex": col, "endColumnIndex": col + 1},
-                "cell": {"userEnteredFormat": {"horizontalAlignment": "RIGHT"}},
-                "fields": "userEnteredFormat.horizontalAlignment"
-            }})
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body={"requests": requests}
-        ).execute()
-        write_log("✅ Sheet1 欄位格式套用完成")
+        done = apply_formatting(service, SHEET_STATE, titles, log=write_log)
+        if done:
+            write_log(f"✅ {'、'.join(done)} 欄位格式套用完成")
+        else:
+            write_log("欄位格式已是最新，略過套用")
     except Exception as e:
-        write_log(f"⚠️ Sheet1 格式套用失敗：{e}")
+        write_log(f"⚠️ 欄位格式套用失敗：{e}")
 
 
 def load_stock_list_from_sheets(service):
@@ -181,21 +208,31 @@ def try_yfinance(stock_id: str, suffix: str):
     tw_symbol = f"{stock_id}.{suffix}"
     for attempt in range(3):
         try:
+            YFINANCE_RATE_LIMITER.acquire()
+            import yfinance as yf
             ticker = yf.Ticker(tw_symbol)
-            hist = ticker.history(period="1d", interval="1m")
+            with TRACER.trace("yfinance", f"history_1m.{suffix}", stock_id) as span:
+                span["retries"] = attempt
+                hist = ticker.history(period="1d", interval="1m")
+                span["bytes"] = payload_size(hist)
             if not hist.empty:
                 latest = hist.iloc[-1]
                 price = float(latest["Close"])
                 time_str = latest.name.strftime("%Y-%m-%d %H:%M:%S")
                 write_log(f"{stock_id} yfinance 取得最新分鐘價（.{suffix}）：{price:.2f} @ {time_str}")
+                SYMBOL_INDEX.remember(stock_id, suffix)
                 return {"price": price, "time": time_str, "source": "today_yfinance", "is_latest": True, "finmind_success": False}
 
-            hist_daily = ticker.history(period="5d")
+            YFINANCE_RATE_LIMITER.acquire()
+            with TRACER.trace("yfinance", f"history_5d.{suffix}", stock_id) as span:
+                hist_daily = ticker.history(period="5d")
+                span["bytes"] = payload_size(hist_daily)
             if not hist_daily.empty:
                 latest = hist_daily.iloc[-1]
                 price = float(latest["Close"])
                 date_str = latest.name.strftime("%Y-%m-%d")
                 write_log(f"{stock_id} yfinance 取得最近日收盤價（.{suffix}）：{price:.2f} ({date_str})")
+                SYMBOL_INDEX.remember(stock_id, suffix)
                 return {"price": price, "time": date_str, "source": "previous_yfinance", "is_latest": False, "finmind_success": False}
 
             return None  # 無資料，換後綴試試
@@ -213,32 +250,166 @@ def try_yfinance(stock_id: str, suffix: str):
     return None
 
 
+# 交易日曆（本機快取），交易日判斷與前一交易日查表用
+TRADING_CALENDAR = TradingCalendar()
+
+# 上市／上櫃市場索引（本機快取），已知市場的股票直接使用正確後綴，不再試探
+SYMBOL_INDEX = SymbolIndex()
+YF_SUFFIXES = ["TW", "TWO"]
+
+
+def _yf_suffix_candidates(stock_id: str):
+    known = SYMBOL_INDEX.suffix(stock_id)
+    return [known] if known else YF_SUFFIXES
+
+
+def _yf_ticker_frame(df, symbol: str):
+    """從 yf.download 的多股結果取出單一代號的資料；查無資料回傳 None。"""
+    if df is None or df.empty:
+        return None
+    if df.columns.nlevels > 1:
+        if symbol not in df.columns.get_level_values(0):
+            return None
+        df = df[symbol]
+    if "Close" not in df.columns:
+        return None
+    df = df.dropna(subset=["Close"])
+    return df if not df.empty else None
+
+
+def _yf_download(symbols, **kwargs):
+    """一次下載多個代號，含 rate limit retry（最多 3 次）。"""
+    import yfinance as yf
+    for attempt in range(3):
+        try:
+            YFINANCE_RATE_LIMITER.acquire()
+            with TRACER.trace("yfinance", f"download_{kwargs.get('interval', '')}") as span:
+                span["retries"] = attempt
+                df = yf.download(
+                    tickers=" ".join(symbols), group_by="ticker",
+                    threads=False, progress=False, auto_adjust=False, **kwargs
+                )
+                span["bytes"] = payload_size(df)
+            return df
+        except Exception as e:
+            if ("Too Many Requests" in str(e) or "Rate limited" in str(e)) and attempt < 2:
+                write_log(f"yfinance 批次下載 rate limit，等 3 秒後重試（第 {attempt + 1} 次）")
+                time.sleep(3)
+            else:
+                write_log(f"yfinance 批次下載失敗：{e}")
+                return None
+    return None
+
+
+def fetch_yfinance_bulk(stock_ids) -> Dict[str, Dict]:
+    """
+    FinMind 失敗的股票一次向 yfinance 批次取價：
+    - 所有待查代號（未知市場的同時帶 .TW 與 .TWO）合併成一次 1 分鐘K下載
+    - 仍查無資料的再合併成一次 5 日日K下載
+    命中的後綴記入市場索引，回傳 {stock_id: 價格資訊}。
+    """
+    results: Dict[str, Dict] = {}
+    if not stock_ids:
+        return results
+
+    pending = list(stock_ids)
+    for period, interval in (("1d", "1m"), ("5d", "1d")):
+        if not pending:
+            break
+        symbols = [f"{sid}.{suffix}" for sid in pending for suffix in _yf_suffix_candidates(sid)]
+        write_log(f"yfinance 批次備援（{interval}）：{len(pending)} 支股票，{len(symbols)} 個代號，1 次請求")
+        df = _yf_download(symbols, period=period, interval=interval)
+
+        for sid in list(pending):
+            for suffix in _yf_suffix_candidates(sid):
+                hist = _yf_ticker_frame(df, f"{sid}.{suffix}")
+                if hist is None:
+                    continue
+                latest = hist.iloc[-1]
+                price = float(latest["Close"])
+                SYMBOL_INDEX.remember(sid, suffix)
+                if interval == "1m":
+                    time_str = latest.name.strftime("%Y-%m-%d %H:%M:%S")
+                    write_log(f"{sid} yfinance 取得最新分鐘價（.{suffix}）：{price:.2f} @ {time_str}")
+                    results[sid] = {"price": price, "time": time_str, "source": "today_yfinance",
+                                    "is_latest": True, "finmind_success": False}
+                else:
+                    date_str = latest.name.strftime("%Y-%m-%d")
+                    write_log(f"{sid} yfinance 取得最近日收盤價（.{suffix}）：{price:.2f} ({date_str})")
+                    results[sid] = {"price": price, "time": date_str, "source": "previous_yfinance",
+                                    "is_latest": False, "finmind_success": False}
+                pending.remove(sid)
+                break
+        del df
+
+    for sid in pending:
+        write_log(f"{sid} FinMind 與 yfinance 都無法取得任何價格")
+    return results
+
+
 def send_discord_push(message: str):
-    if not DISCORD_WEBHOOK_URL:
-        write_log("未設定 DISCORD_WEBHOOK_URL，無法推播 Discord。")
-        return
-    data = {"content": message}
-    try:
-        resp = requests.post(DISCORD_WEBHOOK_URL, json=data, timeout=10)
-        if resp.status_code != 204:
-            write_log(f"Discord 推播失敗，狀態碼：{resp.status_code}，回應：{resp.text}")
-        else:
-            write_log("Discord 推播成功")
-    except Exception as e:
-        write_log(f"Discord 推播失敗：{e}")
+    """立即推播（警告訊息用）；一般個股訊息請用 queue_discord_push 合併送出。"""
+    NOTIFIER.send(message)
+
+
+def queue_discord_push(message: str):
+    """排入推播佇列，main() 結束前由 NOTIFIER.flush() 打包成最少次數的 POST。"""
+    NOTIFIER.queue(message)
 
 
-def write_log(msg):
-    now_str = datetime.now().strftime('%Y年%m月%d日 %H時%M分%S秒')
-    with open("error.log", "a", encoding="utf-8") as f:
-        f.write(f"{now_str} {msg}\n")
-    print(f"{now_str} {msg}")
+# 背景執行緒批次寫入 error.log（支援 JSON 與輪替），程式結束時自動寫完
+LOGGER = create_logger('%Y年%m月%d日 %H時%M分%S秒')
+
+
+def write_log(msg, **fields):
+    LOGGER.log(msg, **fields)
+
+
+# 共用連線池的 Discord 推播器；DISCORD_USE_EMBEDS=1 時改以 embed 打包（每次最多 10 則）
+NOTIFIER = DiscordNotifier(
+    DISCORD_WEBHOOK_URL,
+    use_embeds=os.getenv("DISCORD_USE_EMBEDS") == "1",
+    log=write_log,
+    tracer=TRACER
+)
 
 
 # ======================== 交易日判斷 ========================
-def is_trading_day(dl: DataLoader, check_date: str, is_after_close: bool) -> bool:
+def taiwan_now() -> datetime:
+    """目前台灣時間；設定 NOTIFY_NOW（例如 2026-10-17T08:00:00）時改用指定時間，供本機測試與啟動效能量測。"""
+    tz = timezone(timedelta(hours=8))
+    fake_now = os.getenv("NOTIFY_NOW")
+    if fake_now:
+        return datetime.fromisoformat(fake_now).replace(tzinfo=tz)
+    return datetime.now(tz)
+
+
+def is_trading_day(dl, check_date: str, is_after_close: bool) -> bool:
     """
     判斷指定日期是否為台股交易日
+    - 先查本機交易日曆（週末、已收錄的交易日／假日、今天稍早的判定結果）
+    - 日曆無法判斷時才向 FinMind／yfinance 探測，結果寫回日曆供後續執行使用
+    """
+    known = TRADING_CALENDAR.lookup(check_date, require_final=is_after_close)
+    if known is None:
+        TRADING_CALENDAR.ensure_fresh(dl, check_date, log=write_log)
+        known = TRADING_CALENDAR.lookup(check_date, require_final=is_after_close)
+    if known is not None:
+        write_log(f"交易日曆：{check_date} {'為交易日' if known else '非交易日'}")
+        return known
+
+    result = _probe_trading_day(dl, check_date, is_after_close)
+    if result is None:
+        write_log("無法確認交易日，預設為交易日（避免漏跑）")
+        return True
+    # 盤後確認有日K才是定案；盤後查無日K可能只是資料尚未產生，下次執行再確認
+    TRADING_CALENDAR.record(check_date, result, final=is_after_close and result)
+    return result
+
+
+def _probe_trading_day(dl, check_date: str, is_after_close: bool) -> Optional[bool]:
+    """
+    以實際資料探測是否為交易日，無法確認時回傳 None
     - 盤後：優先檢查當天是否有日K資料
     - 盤中：檢查昨天是否有交易資料（用來推估今天是否可能開盤）
     """
@@ -268,6 +439,7 @@ def is_trading_day(dl: DataLoader, check_date: str, is_after_close: bool) -> boo
     except Exception as e:
         write_log(f"交易日檢查 FinMind 失敗：{e}，改用 yfinance 確認")
         try:
+            import yfinance as yf
             ticker = yf.Ticker("2330.TW")
             # 先查今日 1 分鐘資料：有資料 → 今天確實有開盤
             hist_1m = ticker.history(period="1d", interval="1m")
@@ -286,59 +458,39 @@ def is_trading_day(dl: DataLoader, check_date: str, is_after_close: bool) -> boo
                     return False
         except Exception as e2:
             write_log(f"yfinance 也失敗：{e2}")
-        write_log("無法確認交易日，預設為交易日（避免漏跑）")
-        return True
+        return None
 
 
 # ======================== 價格取得函式 ========================
-def get_latest_available_price(dl, stock_id: str):
-    tz = timezone(timedelta(hours=8))
-    today = datetime.now(tz).strftime("%Y-%m-%d")
-    try:
-        df = dl.get_data(dataset="TaiwanStockPrice", data_id=stock_id, start_date=today)
-        if df is not None and not df.empty and 'close' in df.columns:
-            latest = df.iloc[-1]
-            time_str = latest["date"]
-            if "Time" in df.columns and pd.notna(latest.get("Time", None)):
-                time_str = f"{latest['date']} {latest['Time']}"
-            price = float(latest["close"])
-            write_log(f"{stock_id} 取得當天最新分鐘價（FinMind）：{price:.2f} @ {time_str}")
-            return {
-                "price": price,
-                "time": time_str,
-                "source": "today_tick_finmind",
-                "is_latest": True,
-                "finmind_success": True
-            }
-    except Exception as e:
-        write_log(f"{stock_id} FinMind 當天分鐘價失敗：{e}")
-
-    try:
-        df_day = dl.taiwan_stock_daily(stock_id, start_date=today, end_date=today)
-        if not df_day.empty:
-            price = float(df_day.iloc[0]["close"])
-            write_log(f"{stock_id} 取得當天日收盤價（FinMind）：{price:.2f}")
-            return {
-                "price": price,
-                "time": f"{today} 收盤",
-                "source": "today_daily_finmind",
-                "is_latest": True,
-                "finmind_success": True
-            }
-    except Exception as e:
-        write_log(f"{stock_id} FinMind 當天日收盤價失敗：{e}")
-
-    write_log(f"{stock_id} FinMind 今天完全無資料 → 改用 yfinance 備援（自動偵測 .TW / .TWO）")
-    for suffix in ["TW", "TWO"]:
-        result = try_yfinance(stock_id, suffix)
-        if result:
-            return result
-
-    write_log(f"{stock_id} FinMind 與 yfinance 都無法取得任何價格")
+def get_latest_available_price(dl, stock_id: str, use_yfinance: bool = True, is_after_close: bool = True):
+    """
+    依序向 FinMind 即時價、FinMind 當天日K（use_yfinance=True 時再加 yfinance）取價，由 PRICE_RESOLVER hedge：
+    前一個來源超過 hedge 延遲仍未回應就同時啟動下一個，先取得有效價格者為準。
+    當天日K收盤後才會公布，盤中不查；use_yfinance=False 時交由呼叫端批次備援。
+    FinMind 來源帶著 FINMIND_RATE_LIMITER：取得 token 後才開始計時，限流等待不會觸發 hedge。
+    """
+    today = taiwan_now().strftime("%Y-%m-%d")
+    providers = [FinMindTickProvider(dl, log=write_log, limiter=FINMIND_RATE_LIMITER)]
+    if is_after_close:
+        providers.append(FinMindDailyProvider(dl, log=write_log, limiter=FINMIND_RATE_LIMITER))
+    if use_yfinance:
+        providers.append(YFinanceProvider(try_yfinance, _yf_suffix_candidates))
+    result = PRICE_RESOLVER.resolve(stock_id, today, providers)
+    if result:
+        return result
+
+    if not use_yfinance:
+        write_log(f"{stock_id} FinMind 今天完全無資料 → 排入 yfinance 批次備援")
+    else:
+        write_log(f"{stock_id} FinMind 與 yfinance 都無法取得任何價格")
     return None
 
 
-def get_today_close(dl, stock_id: str, date_str: str) -> Optional[float]:
+def get_today_close(dl, stock_id: str, date_str: str, store: Optional[PriceStore] = None) -> Optional[float]:
+    if store is not None:
+        cached = store.close_on(stock_id, date_str)
+        if cached is not None:
+            return cached
     try:
         df = dl.taiwan_stock_daily(stock_id, start_date=date_str, end_date=date_str)
         if not df.empty:
@@ -349,11 +501,18 @@ def get_today_close(dl, stock_id: str, date_str: str) -> Optional[float]:
         return None
 
 
-def get_prev_close(dl, stock_id: str, before_date: str) -> Optional[float]:
+def get_prev_close(dl, stock_id: str, before_date: str, store: Optional[PriceStore] = None) -> Optional[float]:
     """取得 before_date 之前最近一個交易日的收盤價（最多往回找 7 天，解決週一查到週日的問題）"""
+    yesterday = (datetime.strptime(before_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+    # 本機快取已確認到昨天 → 直接取用，不必再呼叫 FinMind
+    if store is not None and (store.checked_through(stock_id) or "") >= yesterday:
+        cached = store.close_before(stock_id, before_date)
+        if cached is not None:
+            return cached
     try:
-        start = (datetime.strptime(before_date, "%Y-%m-%d") - timedelta(days=7)).strftime("%Y-%m-%d")
-        yesterday = (datetime.strptime(before_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        # 交易日曆知道前一交易日 → 只查那一天；否則往回查 7 天
+        start = TRADING_CALENDAR.previous_trading_day(before_date) or (
+            datetime.strptime(before_date, "%Y-%m-%d") - timedelta(days=7)).strftime("%Y-%m-%d")
         df = dl.taiwan_stock_daily(stock_id, start_date=start, end_date=yesterday)
         if not df.empty:
             return float(df.iloc[-1]["close"])
@@ -363,16 +522,18 @@ def get_prev_close(dl, stock_id: str, before_date: str) -> Optional[float]:
         return None
 
 
-def get_stock_data(dl, stock_id: str) -> Optional[Dict]:
-    now = datetime.now(timezone(timedelta(hours=8)))
+def get_stock_data(dl, stock_id: str, store: Optional[PriceStore] = None,
+                   instant: Optional[Dict] = None) -> Optional[Dict]:
+    now = taiwan_now()
     today = now.strftime("%Y-%m-%d")
     is_after_close = now.hour > 13 or (now.hour == 13 and now.minute >= 30)
 
-    instant = get_latest_available_price(dl, stock_id)
+    if instant is None:
+        instant = get_latest_available_price(dl, stock_id, is_after_close=is_after_close)
     if not instant:
         return None
 
-    yesterday_close = get_prev_close(dl, stock_id, today)
+    yesterday_close = get_prev_close(dl, stock_id, today, store)
     if yesterday_close is None:
         yesterday_close = instant["price"]
 
@@ -389,7 +550,8 @@ def get_stock_data(dl, stock_id: str) -> Optional[Dict]:
     }
 
     if is_after_close:
-        close_price = get_today_close(dl, stock_id, today)
+        close_price = get_today_close(dl, stock_id, today, store)
+        result["official_close"] = close_price  # 日K正式收盤，尚未產生時為 None
         if close_price:
             result["close_price"] = close_price
         else:
@@ -399,29 +561,80 @@ def get_stock_data(dl, stock_id: str) -> Optional[Dict]:
     return result
 
 
-def calculate_ma(prices, window):
-    if len(prices) < window:
+def fetch_finmind_quote(dl, price_store: PriceStore, stock_id: str, today_date: str, is_after_close: bool,
+                        quote: Optional[Dict] = None):
+    """
+    第一階段：補日K快取並向 FinMind 取最新價（不含 yfinance，失敗者稍後批次備援）；
+    快照已取得價格（quote）時直接沿用，不再逐支查詢。
+    """
+    # 本機快取有缺口時，先一次抓下涵蓋「缺口＋前一交易日＋今天」的區間，後續查詢都命中記憶體
+    pending = price_store.pending_range(stock_id, today_date, include_today=is_after_close)
+    if pending:
+        week_ago = (datetime.strptime(today_date, "%Y-%m-%d") - timedelta(days=7)).strftime("%Y-%m-%d")
+        start = min(pending[0], week_ago)
+        try:
+            dl.prefetch(stock_id, start, today_date)
+        except Exception as e:
+            write_log(f"{stock_id} FinMind 日K預先下載失敗：{e}")
+    try:
+        price_store.sync(dl, stock_id, today_date, include_today=is_after_close)
+    except Exception as e:
+        write_log(f"{stock_id} 更新本機日K快取失敗：{e}，均線以快取既有資料計算")
+    if quote:
+        return quote
+    try:
+        return get_latest_available_price(dl, stock_id, use_yfinance=False, is_after_close=is_after_close)
+    except Exception as e:
+        write_log(f"{stock_id} 取得 FinMind 最新價異常：{e}")
         return None
-    return pd.Series(prices).rolling(window).mean().iloc[-1]
 
 
-# ======================== Google Sheets ========================
-def save_to_sheets(service, stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp):
-    if not service:
-        return False
-    try:
-        values = [[stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp]]
-        service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2",
-            valueInputOption="RAW",
-            body={"values": values}
-        ).execute()
-        write_log(f"{stock_id} 寫入 Sheets 成功：{date} - {price:.2f}")
-        return True
-    except Exception as e:
-        write_log(f"{stock_id} 寫入 Sheets 失敗：{e}")
-        return False
+def fetch_stock_bundle(dl, price_store: PriceStore, stock_id: str, instant: Optional[Dict]) -> Dict:
+    """第二階段：以已取得的最新價補齊昨收、今日收盤與均線輸入。"""
+    stock = None
+    if instant:
+        try:
+            stock = get_stock_data(dl, stock_id, price_store, instant=instant)
+        except Exception as e:
+            write_log(f"{stock_id} 取得股價資料異常：{e}")
+
+    # 均線直接讀本機快取（memmap），只取 MA60 需要的最後 60 筆
+    closes = list(price_store.closes(stock_id)[-60:])
+    return {"stock_id": stock_id, "stock": stock, "closes": closes, "last_date": price_store.last_date(stock_id)}
+
+
+def fetch_all_stocks(dl, price_store: PriceStore, stock_ids, today_date: str, is_after_close: bool,
+                     deadline: Optional[Deadline] = None):
+    """
+    以有上限的執行緒池並行抓取所有股票，回傳 (結果依 stock_ids 順序排列, 因期限略過的股票)。
+    QUOTE_MODE=snapshot 時先以一次請求取得整份清單的最新價，快照缺少的股票才逐支查詢。
+    每支股票的最新價與日K在同一個工作內接著抓；超過期限（deadline 的 FETCH_DEADLINE_RATIO）後
+    不再開始新的股票，已開始的股票會抓完。stock_ids 應已依優先順序排列。
+    """
+    snapshot = {}
+    if QUOTE_MODE == "snapshot":
+        snapshot = PRICE_SNAPSHOT.fetch_many(dl, stock_ids, today_date)
+        write_log(f"FinMind 快照取得 {len(snapshot)}/{len(stock_ids)} 支最新價，"
+                  f"其餘 {len(stock_ids) - len(snapshot)} 支逐支查詢")
+    dropped = []
+
+    def fetch_unless_late(stock_id):
+        """回傳 (股票, 結果)；FinMind 取不到價時結果為 None，之後走 yfinance 批次。"""
+        if deadline and deadline.expired(FETCH_DEADLINE_RATIO):
+            dropped.append(stock_id)
+            return None
+        quote = fetch_finmind_quote(dl, price_store, stock_id, today_date, is_after_close, snapshot.get(stock_id))
+        return stock_id, (fetch_stock_bundle(dl, price_store, stock_id, quote) if quote else None)
+
+    with ThreadPoolExecutor(max_workers=max(1, FETCH_CONCURRENCY)) as pool:
+        started = [r for r in pool.map(fetch_unless_late, stock_ids) if r is not None]
+        # FinMind 取不到價的股票合併成一次 yfinance 批次請求
+        missing = [sid for sid, bundle in started if bundle is None]
+        fallback = fetch_yfinance_bulk(missing)
+        late = dict(zip(missing, pool.map(
+            lambda sid: fetch_stock_bundle(dl, price_store, sid, fallback.get(sid)), missing)))
+        bundles = [bundle or late[sid] for sid, bundle in started]
+    return bundles, [sid for sid in stock_ids if sid in dropped]
 
 
 # ======================== 盤中建議 ========================
@@ -479,10 +692,125 @@ def get_after_close_summary(latest, ma5, ma20, change):
         return "今天價格有變動，明天再看情況決定要不要買"
 
 
+# ======================== 連線與常駐狀態 ========================
+class WarmState:
+    """跨週期保留的連線與狀態：單次執行每次都是新的；常駐模式（--daemon）整個交易時段共用。"""
+
+    def __init__(self):
+        self.service = None
+        self.finmind = None          # 已登入的 DataLoader（含限流與計時）；快取層每週期重建，避免沿用舊報價
+        self.price_store = PriceStore()   # 本機日K快取，每次只補抓缺少的尾端
+        self.ma_tracker = MATracker()     # 各股均線串流狀態，盤中新價可直接 push/peek
+        self.ma_basis = {}           # stock_id → (最後日K日期, 收盤筆數, 最後收盤)，日K沒變就不重建均線
+        self.stock_list = None
+        self.stock_name_map = None
+        self.config_loaded_at = None  # time.monotonic()，超過 CONFIG_REFRESH_MINUTES 才重讀 Config
+        self.push_count = None        # (日期, 今日已完成的推播批次)，有值時不必再讀 J1:K1
+
+
+def connect_clients(warm: WarmState) -> bool:
+    """建立（或沿用）Sheets 與 FinMind 連線，失敗回傳 False。"""
+    if warm.service is None:
+        warm.service = get_sheets_service()
+        if not warm.service:
+            write_log("無法連線 Google Sheets，結束執行")
+            return False
+    if warm.finmind is None:
+        from FinMind.data import DataLoader
+        # 限流包在計時外層：計時只量實際網路呼叫，不含限流等待
+        finmind = RateLimited(Traced(DataLoader(), TRACER, "finmind"), FINMIND_RATE_LIMITER)
+        try:
+            finmind.login_by_token(FINMIND_TOKEN)
+        except Exception as e:
+            write_log(f"FinMind 登入失敗：{e}")
+            return False
+        warm.finmind = finmind
+    return True
+
+
+def refresh_stock_list(warm: WarmState):
+    """讀取 Config 股票清單；常駐模式下每 CONFIG_REFRESH_MINUTES 分鐘才重讀一次。"""
+    if warm.stock_list is not None and time.monotonic() - warm.config_loaded_at < CONFIG_REFRESH_MINUTES * 60:
+        return warm.stock_list, warm.stock_name_map
+    sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(warm.service)
+    warm.stock_list = sheets_stock_list if sheets_stock_list else STOCK_LIST
+    warm.stock_name_map = sheets_stock_name_map if sheets_stock_name_map else STOCK_NAME_MAP
+    warm.config_loaded_at = time.monotonic()
+    return warm.stock_list, warm.stock_name_map
+
+
+def next_push_count(warm: WarmState, today_date: str, count_range: str) -> int:
+    """今天第幾次推播：依序看記憶體（常駐模式）與本機計數檔，都沒有今天的記錄才讀一次 Sheets J1:K1。"""
+    if warm.push_count and warm.push_count[0] == today_date:
+        return warm.push_count[1] + 1
+    local = load_json(PUSH_COUNTER_PATH, {}) or {}
+    if local.get("date") == today_date and isinstance(local.get("count"), int):
+        warm.push_count = (today_date, local["count"])
+        return local["count"] + 1
+
+    current_count = 1
+    try:
+        result = warm.service.spreadsheets().values().get(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            range=count_range
+        ).execute()
+        values = result.get('values', [])
+        if values and len(values) > 0 and len(values[0]) >= 2:
+            sheet_date = str(values[0][0]).strip() if values[0][0] else ""
+            sheet_count_str = str(values[0][1]).strip() if len(values[0]) > 1 else ""
+            if sheet_date == today_date and sheet_count_str.isdigit():
+                current_count = int(sheet_count_str) + 1
+            else:
+                write_log(f"Sheets 日期不符或無效：{sheet_date}，本次從 1 開始")
+    except Exception as e:
+        write_log(f"讀取 Sheets 計數失敗：{e}，本次視為第 1 次")
+    return current_count
+
+
+def save_push_count(warm: WarmState, today_date: str, count: int, count_range: str):
+    """推播計數先寫本機（下次直接沿用），再同步到 Sheets J1:K1；同步失敗不影響本機計數。"""
+    warm.push_count = (today_date, count)
+    try:
+        save_json(PUSH_COUNTER_PATH, {"date": today_date, "count": count})
+    except OSError as e:
+        write_log(f"寫入本機推播計數失敗：{e}")
+    try:
+        warm.service.spreadsheets().values().update(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            range=count_range,
+            valueInputOption="USER_ENTERED",
+            body={"values": [[today_date, count]]}
+        ).execute()
+        write_log(f"本次推播完成，更新計數：{today_date} 第 {count} 次（已同步 Sheets）")
+    except Exception as e:
+        write_log(f"同步 Sheets 計數失敗：{e}（本機計數已更新為第 {count} 次）")
+
+
 # ======================== 主程式 ========================
-def main():
-    tz = timezone(timedelta(hours=8))
-    now = datetime.now(tz)
+def cycle_slot(now: datetime) -> int:
+    """盤中第幾個週期（09:30 起每 DAEMON_INTERVAL_MINUTES 分鐘一格），分組輪替用。"""
+    return max(0, (now.hour * 60 + now.minute - 570) // max(1, DAEMON_INTERVAL_MINUTES))
+
+
+def select_cycle_stocks(stock_list, now: datetime, intraday: bool):
+    """
+    本週期要處理的股票：盤中只取輪到的那一組，再加上上個週期因期限略過的股票（不必等到輪回該組）；
+    略過的股票排最前面，其餘依最久未處理優先排序。回傳 (股票清單, 組別說明)。
+    """
+    if intraday and STOCK_SHARDS > 1:
+        slot = cycle_slot(now)
+        shard = STOCK_SCHEDULER.shard(stock_list, slot)
+        stocks = STOCK_SCHEDULER.with_carry_over(shard, stock_list)
+        label = f"第 {slot % STOCK_SHARDS + 1}/{STOCK_SHARDS} 組"
+        if len(stocks) > len(shard):
+            label += f"＋上次略過 {len(stocks) - len(shard)} 支"
+    else:
+        stocks, label = list(stock_list), ""
+    return STOCK_SCHEDULER.prioritize(stocks), label
+
+
+def run_cycle(now: datetime, warm: WarmState):
+    deadline = Deadline(CYCLE_DEADLINE_SECONDS)
     now_str = now.strftime("%Y年%m月%d日 %H時%M分%S秒")
     today_date = now.strftime("%Y-%m-%d")
     hour = now.hour
@@ -495,51 +823,43 @@ def main():
         write_log("盤前時段（09:30 前），略過本次執行")
         return
 
-    service = get_sheets_service()
-    if not service:
-        write_log("無法連線 Google Sheets，結束執行")
+    # 週末與日曆已確定的休市日：不建立 Sheets／FinMind 連線，直接結束
+    is_after_close = hour > 13 or (hour == 13 and minute >= 30)
+    if TRADING_CALENDAR.lookup(today_date, require_final=is_after_close) is False:
+        write_log(f"交易日曆：{today_date} 非交易日，結束本次執行")
         return
 
-    dl = DataLoader()
-    try:
-        dl.login_by_token(FINMIND_TOKEN)
-    except Exception as e:
-        write_log(f"FinMind 登入失敗：{e}")
+    if not connect_clients(warm):
         return
+    service = warm.service
 
-    # ==================== 交易日檢查 ====================
-    is_after_close = hour > 13 or (hour == 13 and minute >= 30)
+    # 快取包在限流外層：命中快取的查詢不佔用 FinMind 請求額度；快取只在本週期內有效
+    dl = CachedDataLoader(warm.finmind, tracer=TRACER)
 
+    # ==================== 交易日檢查 ====================
     if not is_trading_day(dl, today_date, is_after_close):
         write_log(f"今天 {today_date} 判斷為非交易日，結束本次執行")
         return
 
     write_log("通過交易日檢查，開始處理股票資料...")
+    SYMBOL_INDEX.ensure_fresh(dl, today_date, log=write_log)
 
     # ──────────────── 從 Config 分頁讀取股票清單 ────────────────
-    sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(service)
-    active_stock_list = sheets_stock_list if sheets_stock_list else STOCK_LIST
-    active_stock_name_map = sheets_stock_name_map if sheets_stock_name_map else STOCK_NAME_MAP
+    active_stock_list, active_stock_name_map = refresh_stock_list(warm)
+
+    # ==================== 原有推播時間判斷 ====================
+    is_yesterday_push = (hour == 13 and 31 <= minute < 59)
+    is_today_push = (hour >= 14)
+
+    # 清單很長時盤中分組輪流處理，並依最久未處理優先排序
+    cycle_stocks, shard_label = select_cycle_stocks(active_stock_list, now,
+                                                    intraday=not (is_yesterday_push or is_today_push))
+    if shard_label:
+        write_log(f"本週期處理{shard_label}：{len(cycle_stocks)}/{len(active_stock_list)} 支")
 
     # ──────────────── 使用 Google Sheets 記錄當天推播批次計數 ────────────────
     count_range = f"{SHEET_NAME}!J1:K1"  # J1: 日期, K1: 計數
-
-    current_count = 1
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=count_range
-        ).execute()
-        values = result.get('values', [])
-        if values and len(values) > 0 and len(values[0]) >= 2:
-            sheet_date = str(values[0][0]).strip() if values[0][0] else ""
-            sheet_count_str = str(values[0][1]).strip() if len(values[0]) > 1 else ""
-            if sheet_date == today_date and sheet_count_str.isdigit():
-                current_count = int(sheet_count_str) + 1
-            else:
-                write_log(f"Sheets 日期不符或無效：{sheet_date}，本次從 1 開始")
-    except Exception as e:
-        write_log(f"讀取 Sheets 計數失敗：{e}，本次視為第 1 次")
+    current_count = next_push_count(warm, today_date, count_range)
 
     # ──────────────── 推播批次標題 ────────────────
     title_text = "盤中更新"
@@ -550,47 +870,62 @@ def main():
 
     batch_title = [
         "════════════════════════════════════════════════════════════",
-        f"📢 今日第 {current_count} 次 {title_text}　{now_str}",
+        f"📢 今日第 {current_count} 次 {title_text}{'（' + shard_label + '）' if shard_label else ''}　{now_str}",
         "════════════════════════════════════════════════════════════",
         ""
     ]
-    send_discord_push("\n".join(batch_title))
-    time.sleep(1.0)  # 縮短為 1 秒，避免卡太久
+    queue_discord_push("\n".join(batch_title))
 
-    # ==================== 原有推播時間判斷 ====================
-    is_yesterday_push = (hour == 13 and 31 <= minute < 59)
-    is_today_push = (hour >= 14)
+    # 分頁配置（SHEET_LAYOUT=per_stock）下，盤後寫入前先補建新加入股票的分頁
+    if is_today_push and is_per_stock():
+        try:
+            ensure_stock_tabs(service, SHEET_STATE, active_stock_list, log=write_log)
+        except Exception as e:
+            write_log(f"建立股票分頁失敗：{e}")
 
     success = True  # 用來判斷是否完整執行所有股票
+    ma_tracker = warm.ma_tracker
+    price_store = warm.price_store
     holiday_skipped = 0  # 記錄因今日無即時資料（國定假日）而跳過的股票數
-
-    for stock_id in active_stock_list:
+    is_intraday = not (is_yesterday_push or is_today_push)
+    pushed = 0       # 本批次實際排入推播的股票數
+    unchanged = []   # 盤中與上次推播相比沒有明顯變動的股票（只列入摘要）
+
+    # 先並行完成所有網路抓取，再依清單順序格式化與推播
+    hedges_before = PRICE_RESOLVER.hedges
+    bundles, dropped = fetch_all_stocks(dl, price_store, cycle_stocks, today_date, is_after_close, deadline)
+    write_log(f"並行抓取 {len(bundles)} 支股票完成（並行數 {FETCH_CONCURRENCY}，"
+              f"hedge {PRICE_RESOLVER.hedges - hedges_before} 次）")
+    try:
+        PRICE_LATENCY.save()
+    except OSError as e:
+        write_log(f"寫入取價延遲統計失敗：{e}")
+
+    # 抓取依優先順序，推播仍依 Config 清單順序
+    config_order = {stock_id: i for i, stock_id in enumerate(active_stock_list)}
+    bundles.sort(key=lambda b: config_order.get(b["stock_id"], len(config_order)))
+    sheet_rows = []  # 盤後收盤資料，迴圈結束後一次寫入
+    for bundle in bundles:
+        stock_id = bundle["stock_id"]
         stock_name = active_stock_name_map.get(stock_id, stock_id)
-        stock = get_stock_data(dl, stock_id)
+        stock = bundle["stock"]
         if not stock:
             write_log(f"{stock_id} 無法取得資料，跳過")
             success = False
-            send_discord_push(
+            queue_discord_push(
                 f"⚠️ **{stock_id} {stock_name}** 無法取得資料，本次已跳過\n"
                 f"可能原因：代號錯誤 / 已下市 / 暫時性 API 問題"
             )
             continue
 
-        # 取得近 90 天收盤價計算均線（90天≈63交易日，足以計算MA60）
-        try:
-            df = dl.taiwan_stock_daily(
-                stock_id,
-                start_date=(now - timedelta(days=90)).strftime("%Y-%m-%d"),
-                end_date=now.strftime("%Y-%m-%d")
-            )
-            closes = df["close"].tolist() if not df.empty else []
-        except Exception as e:
-            write_log(f"{stock_id} 取得均線歷史資料失敗：{e}，均線以無資料顯示")
-            closes = []
-
-        ma5 = calculate_ma(closes, 5)
-        ma20 = calculate_ma(closes, 20)
-        ma60 = calculate_ma(closes, 60)
+        closes = bundle["closes"]
+        # 收盤只取最後 60 筆，筆數會固定；新日K與前一天同價時只有日期會變
+        basis = (bundle["last_date"], len(closes), float(closes[-1]) if len(closes) else None)
+        if warm.ma_basis.get(stock_id) != basis:
+            ma_tracker.seed(stock_id, closes)
+            warm.ma_basis[stock_id] = basis
+        mas = ma_tracker.values(stock_id)
+        ma5, ma20, ma60 = mas[5], mas[20], mas[60]
 
         ma5_str = f"{ma5:.2f}" if ma5 is not None else "無資料"
         ma20_str = f"{ma20:.2f}" if ma20 is not None else "無資料"
@@ -607,6 +942,8 @@ def main():
                 source_note = f"（{stock['latest_time']}）"
             elif stock["source"] == "today_daily_finmind":
                 source_note = f"（{stock['latest_time']} 當天收盤）"
+            elif stock["source"] == "today_market_finmind":
+                source_note = f"（{stock['latest_time']} 全市場當日資料）"
             else:
                 source_note = f"（{stock['latest_time']}）"
         else:
@@ -637,13 +974,13 @@ def main():
                 f"建議：{get_intraday_advice(yesterday_close, ma5, ma20, 0)}",
                 "※ 資料來源：FinMind"
             ]
-            send_discord_push("\n".join(msg))
-            write_log(f"{stock_id} 推播昨日收盤價完成")
-            time.sleep(1.0)
+            queue_discord_push("\n".join(msg))
+            pushed += 1
+            write_log(f"{stock_id} 昨日收盤價訊息已排入推播")
             continue
 
         if is_today_push and stock["is_after_close"]:
-            close_price_for_sheet = get_today_close(dl, stock_id, stock["date"])
+            close_price_for_sheet = stock.get("official_close")
             if close_price_for_sheet is None:
                 write_log(f"{stock_id} 盤後寫入：FinMind 當天日K尚未有資料，跳過寫入")
                 close_price = stock["latest_price"]
@@ -669,14 +1006,12 @@ def main():
             ]
 
             if close_price_for_sheet is not None:
-                save_to_sheets(
-                    service, stock_id, stock_name, stock["date"],
-                    close_price_for_sheet, ma5, ma20, ma60, now_str
-                )
+                sheet_rows.append([stock_id, stock_name, stock["date"], close_price_for_sheet,
+                                   ma5, ma20, ma60, now_str])
 
-            send_discord_push("\n".join(msg))
-            write_log(f"{stock_id} 推播盤後資訊完成")
-            time.sleep(1.0)
+            queue_discord_push("\n".join(msg))
+            pushed += 1
+            write_log(f"{stock_id} 盤後資訊已排入推播")
             continue
 
         # 盤中推播 — 若今日無即時資料（國定假日），略過避免推出舊收盤
@@ -686,6 +1021,13 @@ def main():
             success = False
             continue
 
+        # 價格變動未超過門檻且建議相同 → 不重複推播完整訊息
+        advice = get_intraday_advice(latest, ma5, ma20, pct)
+        if not PUSH_STATE.changed(today_date, stock_id, latest, advice):
+            unchanged.append(f"{stock_id} {stock_name} {latest:.2f}（{pct:+.2f}%）")
+            write_log(f"{stock_id} 與上次推播相比無明顯變動，列入未變動摘要")
+            continue
+
         msg = header + [
             f"---",
             f"【{stock_id} {stock_name} 盤中監控 {now.strftime('%Y年%m月%d日')}】",
@@ -697,38 +1039,211 @@ def main():
             f"5日均線：{ma5_str}",
             f"20日均線：{ma20_str}",
             f"60日均線：{ma60_str}",
-            f"建議：{get_intraday_advice(latest, ma5, ma20, pct)}",
+            f"建議：{advice}",
             footnote
         ]
 
-        send_discord_push("\n".join(msg))
-        write_log(f"{stock_id} 盤中推播完成")
-        time.sleep(1.0)  # 個股間隔，避免太密集
+        queue_discord_push("\n".join(msg))
+        PUSH_STATE.stage(stock_id, latest, ma5, ma20, ma60, advice, now_str)
+        pushed += 1
+        write_log(f"{stock_id} 盤中訊息已排入推播")
+
+    if unchanged:
+        shown = "、".join(unchanged[:20]) + (f" 等 {len(unchanged)} 支" if len(unchanged) > 20 else "")
+        queue_discord_push(f"📋 與上次推播相比無明顯變動 {len(unchanged)} 支：{shown}")
+
+    # 盤後收盤資料一次寫入（single：一次 append；per_stock：一次 batchUpdate）
+    if sheet_rows:
+        try:
+            append_history_rows(service, SHEET_STATE, sheet_rows)
+            write_log(f"寫入 Sheets 成功：{len(sheet_rows)} 支股票盤後收盤資料")
+        except Exception as e:
+            write_log(f"寫入 Sheets 失敗：{e}")
+
+    try:
+        STOCK_SCHEDULER.mark_served([b["stock_id"] for b in bundles], now, dropped)
+    except OSError as e:
+        write_log(f"寫入排程狀態失敗：{e}")
+
+    # ──────────────── 時間不足略過的股票：記錄並回報，下次優先處理 ────────────────
+    if dropped:
+        write_log(f"週期期限 {CYCLE_DEADLINE_SECONDS:.0f} 秒內未能處理 {len(dropped)} 支，下次優先：{dropped}")
+        shown = ", ".join(dropped[:20]) + (f" 等 {len(dropped)} 支" if len(dropped) > 20 else "")
+        queue_discord_push(f"⏱️ 本次時間不足，略過 {len(dropped)} 支股票（下次優先處理）：{shown}")
+        success = False  # 有股票沒處理到，不算完整的一次推播
 
     # ──────────────── 國定假日：所有股票盤中均無即時資料 ────────────────
-    if not is_yesterday_push and not is_today_push and holiday_skipped == len(active_stock_list):
-        send_discord_push(
+    if not is_yesterday_push and not is_today_push and holiday_skipped == len(bundles) and bundles:
+        queue_discord_push(
             "📢 今日所有股票尚無盤中即時資料（可能剛開盤或資料源延遲），本次略過盤中推播"
         )
 
+    # 盤中所有股票都沒有變動、也沒有警告 → 整批不送出，計數不增加
+    nothing_changed = is_intraday and bundles and not pushed and success and not dropped
+    if nothing_changed:
+        NOTIFIER.discard()
+        write_log(f"盤中 {len(unchanged)} 支股票與上次推播相比皆無明顯變動，本次不推播")
+    else:
+        if os.getenv("DISCORD_TIMING_FOOTER") == "1":
+            queue_discord_push(TRACER.footer())
+
+        # 所有訊息一次打包送出（2000 字／10 embed 上限內盡量合併，依 rate limit 標頭等待）
+        if NOTIFIER.flush():
+            try:
+                PUSH_STATE.commit(today_date)
+            except OSError as e:
+                write_log(f"寫入推播狀態失敗：{e}")
+        else:
+            PUSH_STATE.discard()
+
     # ──────────────── 只有完整執行才更新計數到 Sheets ────────────────
     if success:
+        if not nothing_changed:  # 沒有送出的批次不佔用計數
+            save_push_count(warm, today_date, current_count, count_range)
+    else:
+        write_log(f"本次推播未完整執行 {len(cycle_stocks)} 支股票，不更新計數")
+
+    hits, misses, per_stock = dl.stats()
+    write_log(f"FinMind 日K快取：命中 {hits} 次、實際呼叫 {misses} 次；各股呼叫次數 {per_stock}")
+
+    apply_sheet_formatting(service, active_stock_list)
+    # 期限只約束抓取階段；寫入 Sheets 與推播使用剩下的 20%，由各自的逾時與重試次數限制，超過時記錄下來
+    if deadline.expired():
+        write_log(f"⚠️ 本週期耗時 {deadline.elapsed():.1f} 秒，超過期限 {CYCLE_DEADLINE_SECONDS:.0f} 秒"
+                  f"（寫入 Sheets／推播階段不受期限中斷）")
+    else:
+        write_log(f"本週期耗時 {deadline.elapsed():.1f} 秒（期限 {CYCLE_DEADLINE_SECONDS:.0f} 秒）")
+
+
+def main():
+    run_cycle(taiwan_now(), WarmState())
+
+
+# ======================== 常駐模式 ========================
+def daemon_schedule(day: datetime):
+    """某一天的執行時間點（台灣時間）：09:30 起每 N 分鐘盤中、13:31 昨收、盤後各時間點。"""
+    base = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    times = []
+    t = base.replace(hour=9, minute=30)
+    while t < base.replace(hour=13, minute=30):
+        times.append(t)
+        t += timedelta(minutes=DAEMON_INTERVAL_MINUTES)
+    times.append(base.replace(hour=13, minute=31))
+    for hm in DAEMON_POST_CLOSE_TIMES.split(","):
+        hour, minute = (int(x) for x in hm.strip().split(":"))
+        times.append(base.replace(hour=hour, minute=minute))
+    return sorted(times)
+
+
+def next_run_time(now: datetime) -> Optional[datetime]:
+    """now 之後的下一個執行時間；日曆確定休市的日子整天跳過（盤中推估的結果不算，盤後仍會再確認）。"""
+    day = now
+    for _ in range(14):
+        if TRADING_CALENDAR.lookup(day.strftime("%Y-%m-%d"), require_final=True) is not False:
+            for t in daemon_schedule(day):
+                if t > now:
+                    return t
+        day = (day + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return None
+
+
+def _sleep_until(target: datetime) -> bool:
+    """等到指定時間；收到停止訊號時回傳 False。"""
+    while not DAEMON_STOP.is_set():
+        remaining = (target - taiwan_now()).total_seconds()
+        if remaining <= 0:
+            return True
+        DAEMON_STOP.wait(min(remaining, 60))
+    return False
+
+
+def run_daemon():
+    """
+    常駐模式：同一個行程跑完整個交易時段，自行排程盤中、13:31 與盤後週期。
+    Sheets／FinMind 連線、日K快取、均線狀態、股票清單與推播計數都留在記憶體，
+    每個週期只需抓最新報價；每週期各自寫一筆效能摘要。
+    """
+    signal.signal(signal.SIGTERM, lambda *_: DAEMON_STOP.set())
+    signal.signal(signal.SIGINT, lambda *_: DAEMON_STOP.set())
+    lock = RunLock("stock-multi-notify")
+    if not lock.acquire():
+        holder = lock.holder() or {}
+        write_log(f"已有執行中的推播程式（pid {holder.get('pid')}，{holder.get('started_at')} 開始），常駐模式不啟動")
+        return
+    warm = WarmState()
+    write_log(f"常駐模式啟動：盤中每 {DAEMON_INTERVAL_MINUTES} 分鐘、13:31 昨收、盤後 {DAEMON_POST_CLOSE_TIMES}")
+    while not DAEMON_STOP.is_set():
+        run_at = next_run_time(taiwan_now())
+        if run_at is None:
+            write_log("兩週內找不到交易日，1 小時後再檢查")
+            DAEMON_STOP.wait(3600)
+            continue
+        write_log(f"下次執行：{run_at.strftime('%Y-%m-%d %H:%M')}")
+        if not _sleep_until(run_at):
+            break
+        TRACER.reset()
+        RUN_LEDGER.start()
+        status = "error"
         try:
-            update_values = [[today_date, current_count]]
-            service.spreadsheets().values().update(
-                spreadsheetId=GOOGLE_SHEET_ID,
-                range=count_range,
-                valueInputOption="USER_ENTERED",
-                body={"values": update_values}
-            ).execute()
-            write_log(f"本次推播完成，更新 Sheets 計數：{today_date} 第 {current_count} 次")
+            run_cycle(taiwan_now(), warm)
+            status = "ok"
         except Exception as e:
-            write_log(f"更新 Sheets 計數失敗：{e}")
-    else:
-        write_log(f"本次推播未完整執行 {len(active_stock_list)} 支股票，不更新計數")
+            write_log(f"本週期執行失敗：{e}")
+        finally:
+            record_run(status)
+            write_run_summary()
+    lock.release()
+    write_log("常駐模式結束")
+
 
-    apply_sheet_formatting(service)
+def record_run(status, waited=0.0, **fields):
+    try:
+        RUN_LEDGER.record(status, TRACER.run_id, waited, **fields)
+    except OSError as e:
+        write_log(f"寫入執行紀錄失敗：{e}")
+
+
+def run_once():
+    """
+    cron 模式：取得本機鎖才執行。前一次還沒結束時最多等 RUN_LOCK_WAIT_SECONDS 秒，
+    仍取不到就略過本次（不重複推播、不搶計數），每次執行都寫入執行紀錄。
+    """
+    lock = RunLock("stock-multi-notify")
+    RUN_LEDGER.start()
+    if not lock.acquire(RUN_LOCK_WAIT_SECONDS):
+        holder = lock.holder() or {}
+        write_log(f"前一次執行尚未結束（pid {holder.get('pid')}，{holder.get('started_at')} 開始），略過本次")
+        record_run("skipped", lock.waited, holder=holder)
+        return
+    if lock.waited:
+        write_log(f"等待前一次執行結束 {lock.waited:.1f} 秒後開始")
+    status = "error"
+    try:
+        main()
+        status = "ok"
+    finally:
+        lock.release()
+        record_run(status, lock.waited)
+        write_run_summary()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="多股盤中／盤後推播")
+    parser.add_argument("--daemon", action="store_true",
+                        help="常駐執行，自行排程整個交易時段（取代每 5 分鐘的 cron）")
+    return parser.parse_args()
+
+
+def write_run_summary():
+    try:
+        TRACER.write_summary()
+        write_log(TRACER.footer())
+    except Exception as e:
+        write_log(f"寫入執行效能紀錄失敗：{e}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if parse_args().daemon:
+        run_daemon()
+    else:
+        run_once()
\ No newline at end of file
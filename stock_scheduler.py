@@ -0,0 +1,63 @@
+"""
+大量監控股票的週期排程：
+- 分組（STOCK_SHARDS）：盤中週期依時段輪流處理其中一組，每支股票每 N 個週期更新一次
+- 優先順序：上個週期因時間不足被略過的股票不論分組都排進下個週期的最前面，
+  其餘最久沒處理到的股票排前面（從未處理的最優先）
+- 期限（Deadline）：週期超過期限就不再開始新的股票，讓整個週期在排程間隔內結束、不與下一次重疊
+最後處理時間與被略過的股票存於本機快取（stock_schedule.json），cron 模式每次啟動也能延續。
+"""
+import time
+from datetime import datetime
+
+from local_cache import cache_path, load_json, save_json
+
+
+class Deadline:
+    """以 monotonic 計時的期限；seconds <= 0 表示不限時。"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def expired(self, fraction=1.0):
+        """是否已用掉期限的 fraction 比例（例如 0.8 表示只剩 20% 給推播與寫入）。"""
+        return self.seconds > 0 and self.elapsed() >= self.seconds * fraction
+
+
+class StockScheduler:
+    def __init__(self, shards=1, path=None):
+        self.shards = max(1, int(shards))
+        self.path = path or cache_path("stock_schedule.json")
+        data = load_json(self.path, {}) or {}
+        self.last_served = data.get("last_served", {})  # stock_id → 最後處理時間
+        self.carry_over = data.get("carry_over", [])    # 上個週期因期限被略過的股票
+
+    def shard(self, stock_list, slot):
+        """第 slot 個週期要處理的那一組（依清單位置分組，清單不變時每組成員固定）。"""
+        if self.shards <= 1:
+            return list(stock_list)
+        index = slot % self.shards
+        return [s for i, s in enumerate(stock_list) if i % self.shards == index]
+
+    def with_carry_over(self, selected, stock_list):
+        """在本週期的股票前面補上上個週期被略過、但不在這一組的股票（已從清單移除的不補）。"""
+        chosen = set(selected)
+        active = set(stock_list)
+        return [s for s in self.carry_over if s in active and s not in chosen] + list(selected)
+
+    def prioritize(self, stock_list):
+        """上個週期被略過的排最前面，其餘最久沒處理到的排前面；處理時間相同時維持 Config 順序。"""
+        order = {stock_id: i for i, stock_id in enumerate(stock_list)}
+        carried = set(self.carry_over)
+        return sorted(stock_list, key=lambda s: (s not in carried, self.last_served.get(s, ""), order[s]))
+
+    def mark_served(self, stock_ids, when=None, dropped=()):
+        """記錄本週期處理過的股票與因期限略過的股票（下個週期優先）；先更新記憶體再寫入快取。"""
+        when = (when or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+        for stock_id in stock_ids:
+            self.last_served[stock_id] = when
+        self.carry_over = list(dropped)
+        save_json(self.path, {"last_served": self.last_served, "carry_over": self.carry_over})
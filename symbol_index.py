@@ -0,0 +1,61 @@
+"""
+股票上市／上櫃市場索引（本機快取），決定 yfinance 要用 .TW 還是 .TWO，不必每次試探。
+資料來源為 FinMind TaiwanStockInfo，每天最多更新一次；yfinance 實際查到的後綴也會記錄進來。
+"""
+import threading
+
+from local_cache import cache_path, load_json, save_json
+
+# FinMind TaiwanStockInfo 的 type 欄位 → yfinance 後綴
+MARKET_SUFFIX = {"twse": "TW", "tpex": "TWO", "emerging": "TWO"}
+
+
+class SymbolIndex:
+    def __init__(self, path=None):
+        self.path = path or cache_path("symbol_index.json")
+        data = load_json(self.path, {}) or {}
+        self.updated = data.get("updated")
+        self.suffixes = data.get("suffixes", {})
+        self._lock = threading.Lock()
+
+    def _save(self):
+        save_json(self.path, {"updated": self.updated, "suffixes": self.suffixes})
+
+    def is_stale(self, today):
+        return self.updated != today
+
+    def refresh(self, dl, today):
+        """從 FinMind 股票基本資料重建索引，回傳收錄的股票數。"""
+        df = dl.taiwan_stock_info()
+        suffixes = {}
+        for stock_id, market in zip(df["stock_id"], df["type"]):
+            suffix = MARKET_SUFFIX.get(str(market).lower())
+            if suffix:
+                suffixes[str(stock_id)] = suffix
+        with self._lock:
+            # FinMind 沒收錄、但 yfinance 曾查到的代號保留原紀錄
+            self.suffixes = {**self.suffixes, **suffixes}
+            self.updated = today
+            self._save()
+        return len(suffixes)
+
+    def ensure_fresh(self, dl, today, log=print):
+        """索引不是今天建立的才重新下載；失敗時沿用舊索引。"""
+        if not self.is_stale(today):
+            return
+        try:
+            count = self.refresh(dl, today)
+            log(f"股票市場索引已更新：{count} 檔")
+        except Exception as e:
+            log(f"股票市場索引更新失敗：{e}，沿用既有索引（{len(self.suffixes)} 檔）")
+
+    def suffix(self, stock_id):
+        return self.suffixes.get(stock_id)
+
+    def remember(self, stock_id, suffix):
+        """記錄 yfinance 實際查到資料的後綴。"""
+        with self._lock:
+            if self.suffixes.get(stock_id) == suffix:
+                return
+            self.suffixes[stock_id] = suffix
+            self._save()
@@ -0,0 +1,95 @@
+"""
+台股交易日曆（本機快取）：用 FinMind TaiwanStockTradingDate 每天最多更新一次，
+is_trading_day 與「前一交易日」改為記憶體查表，不必每次執行都下載 2330 日K來推估。
+"""
+import threading
+from datetime import datetime, timedelta
+
+from local_cache import cache_path, load_json, save_json
+
+REFRESH_LOOKBACK_DAYS = 60   # 首次建立時往回抓的天數
+KEEP_DAYS = 400              # 只保留最近一年多的交易日，避免檔案無限增長
+
+
+def _shift(date_str, days):
+    return (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+class TradingCalendar:
+    def __init__(self, path=None):
+        self.path = path or cache_path("trading_calendar.json")
+        data = load_json(self.path, {}) or {}
+        self.trading_dates = set(data.get("trading_dates", []))
+        self.covered_through = data.get("covered_through")  # 此日期（含）以前的交易日已完整收錄
+        self.refreshed = data.get("refreshed")
+        # 以探測方式判定的日期：{date: {"trading": bool, "final": bool}}，final=False 為盤中推估
+        self.decided = data.get("decided", {})
+        self._lock = threading.Lock()
+
+    def _save(self):
+        save_json(self.path, {
+            "trading_dates": sorted(self.trading_dates),
+            "covered_through": self.covered_through,
+            "refreshed": self.refreshed,
+            "decided": self.decided,
+        })
+
+    def refresh(self, dl, today):
+        """向 FinMind 補抓交易日（若資料集已公布未來交易日也一併收錄）。"""
+        start = _shift(self.covered_through, 1) if self.covered_through else _shift(today, -REFRESH_LOOKBACK_DAYS)
+        df = dl.get_data(dataset="TaiwanStockTradingDate", start_date=start, end_date=f"{today[:4]}-12-31")
+        dates = [str(d)[:10] for d in df["date"]] if df is not None and not df.empty else []
+        with self._lock:
+            cutoff = _shift(today, -KEEP_DAYS)
+            self.trading_dates = {d for d in self.trading_dates.union(dates) if d >= cutoff}
+            if dates:
+                self.covered_through = max([self.covered_through or "", *dates])
+            self.decided = {d: v for d, v in self.decided.items() if d >= cutoff}
+            self.refreshed = today
+            self._save()
+        return len(dates)
+
+    def ensure_fresh(self, dl, today, log=print):
+        if self.refreshed == today:
+            return
+        try:
+            count = self.refresh(dl, today)
+            log(f"交易日曆已更新：新增 {count} 個交易日，收錄至 {self.covered_through}")
+        except Exception as e:
+            log(f"交易日曆更新失敗：{e}，沿用既有資料")
+
+    def lookup(self, date_str, require_final=False):
+        """回傳 True／False；日曆無法判斷時回傳 None。"""
+        if datetime.strptime(date_str, "%Y-%m-%d").weekday() >= 5:
+            return False
+        if date_str in self.trading_dates:
+            return True
+        if self.covered_through and date_str <= self.covered_through:
+            return False
+        decided = self.decided.get(date_str)
+        if decided and (decided["final"] or not require_final):
+            return decided["trading"]
+        return None
+
+    def record(self, date_str, trading, final):
+        """記錄探測結果；盤中推估（final=False）不會覆蓋已確定的結果。"""
+        with self._lock:
+            current = self.decided.get(date_str)
+            if current and current["final"] and not final:
+                return
+            self.decided[date_str] = {"trading": bool(trading), "final": bool(final)}
+            if trading and final:
+                self.trading_dates.add(date_str)
+            self._save()
+
+    def previous_trading_day(self, date_str):
+        """date_str 之前最近的交易日；中間有無法確認的日期時回傳 None。"""
+        day = _shift(date_str, -1)
+        for _ in range(15):
+            known = self.lookup(day, require_final=True)
+            if known is None:
+                return None
+            if known:
+                return day
+            day = _shift(day, -1)
+        return None